@@ -0,0 +1,68 @@
+"""Benchmark queue ingestion using serial and parallel workers
+
+python benchmarks/ingest.py --count 20000 --workers 1 4 8
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from ddnsmulti.queue import ChangeRequestQueue
+
+CHANGE_REQUEST_TEMPLATE = """zone: example.com
+change: d{n}.example.com
+
+ttl: 86400
+
+from:
+  - "d{n}.example.com. NS ns1.d{n}.example.com."
+  - "d{n}.example.com. NS ns2.d{n}.example.com."
+  - "ns1.d{n}.example.com. A 10.0.{a}.{b}"
+  - "ns2.d{n}.example.com. AAAA 2001:db8::{n:x}"
+
+to:
+  - "d{n}.example.com. NS ns1.d{n}.example.com."
+  - "d{n}.example.com. NS ns3.d{n}.example.com."
+  - "ns1.d{n}.example.com. A 10.0.{a}.{b}"
+  - "ns3.d{n}.example.com. AAAA 2001:db8:1::{n:x}"
+"""
+
+
+def change_request(n: int) -> str:
+    return CHANGE_REQUEST_TEMPLATE.format(n=n, a=(n >> 8) & 255, b=n & 255)
+
+
+def generate_queue(directory: str, count: int) -> None:
+    """Write count synthetic change requests to directory"""
+    for n in range(count):
+        with open(os.path.join(directory, f"{n:08d}.yaml"), "wt") as output_file:
+            output_file.write(change_request(n))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Queue ingestion benchmark")
+    parser.add_argument("--count", type=int, default=10000, help="Queue size")
+    parser.add_argument(
+        "--workers", type=int, nargs="+", default=[1, os.cpu_count()], help="Workers"
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as queuedir:
+        generate_queue(queuedir, args.count)
+        baseline = None
+        for workers in args.workers:
+            queue = ChangeRequestQueue(queue_directory=queuedir, workers=workers)
+            start = time.perf_counter()
+            queue.update_queue()
+            elapsed = time.perf_counter() - start
+            baseline = baseline or elapsed
+            print(
+                f"workers={workers} entries={len(queue)} "
+                f"time={elapsed:.3f}s rate={len(queue) / elapsed:.0f}/s "
+                f"speedup={baseline / elapsed:.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
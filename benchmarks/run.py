@@ -0,0 +1,197 @@
+"""Benchmark suite
+
+Generates a synthetic queue and measures ingestion, index load/save,
+message building and end-to-end send throughput against an in-process
+UPDATE responder. Results can be written as JSON for comparison between
+releases.
+
+python benchmarks/run.py --count 10000 --latency 0.001 --output results.json
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+from importlib import metadata
+
+import dns.tsig
+from ingest import generate_queue
+
+from ddnsmulti.config import UpdaterConfig
+from ddnsmulti.connection import DEFAULT_TRANSPORT, TRANSPORTS
+from ddnsmulti.index import INDEX_FORMATS
+from ddnsmulti.queue import ChangeRequestQueue
+from ddnsmulti.sender import UpdateSender
+from ddnsmulti.wire import MessageCache
+
+# the UPDATE responder is shared with the tests
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests"))
+from fakeserver import FakeServer  # noqa: E402 isort:skip
+
+TSIG_SECRET = "4Tc0K1QkcMCs7cOW2LuSWnxQY0qysdvsZlSb4yTN9pA="
+
+CONFIG_TEMPLATE = """
+queuedir: {queuedir}
+concurrency: {concurrency}
+batch_size: {batch_size}
+nameservers:
+  - address: 127.0.0.1
+    port: {port}
+    concurrency: {concurrency}
+    connections: {connections}
+    transport: {transport}
+    timeout: {timeout}
+    tsig:
+      name: benchmark.
+      key: {secret}
+      alg: hmac-sha256
+"""
+
+
+def measure(count: int, start: float) -> dict:
+    elapsed = time.perf_counter() - start
+    return {"count": count, "seconds": elapsed, "rate": count / elapsed}
+
+
+def bench_ingest(queuedir: str, workers: int) -> dict:
+    queue = ChangeRequestQueue(queue_directory=queuedir, workers=workers)
+    start = time.perf_counter()
+    queue.update_queue()
+    return measure(len(queue), start)
+
+
+def bench_index(queuedir: str, tmpdir: str, index_format: str) -> dict:
+    index = os.path.join(tmpdir, f"index-{index_format}.json")
+    queue = ChangeRequestQueue(
+        queue_directory=queuedir, index=index, index_format=index_format
+    )
+    queue.load_index()
+    queue.update_queue()
+    start = time.perf_counter()
+    queue.save_index()
+    save = measure(len(queue), start)
+    start = time.perf_counter()
+    queue.load_index()
+    load = measure(len(queue), start)
+    return {"save": save, "load": load}
+
+
+def bench_build(queue: ChangeRequestQueue) -> dict:
+    messages = MessageCache(max_size=len(queue))
+    start = time.perf_counter()
+    for qe in queue:
+        messages.get(qe)
+    return measure(len(queue), start)
+
+
+async def bench_send(queue: ChangeRequestQueue, args: argparse.Namespace) -> dict:
+    key = dns.tsig.Key("benchmark.", base64.b64decode(TSIG_SECRET), "hmac-sha256")
+    responder = FakeServer(
+        udp=True,
+        keyring=key,
+        latency=args.latency,
+        failure_rate=args.failure_rate,
+        refused_rate=args.refused_rate,
+        record=False,
+    )
+    await responder.start()
+    config = UpdaterConfig.from_yaml(
+        CONFIG_TEMPLATE.format(
+            queuedir=queue.queue_directory,
+            concurrency=args.concurrency,
+            batch_size=args.batch_size,
+            port=responder.port,
+            connections=args.connections,
+            transport=args.transport,
+            timeout=args.timeout,
+            secret=TSIG_SECRET,
+        )
+    )
+    try:
+        async with UpdateSender(config, messages=MessageCache(len(queue))) as sender:
+            start = time.perf_counter()
+            await sender.send(queue)
+            res = measure(len(queue), start)
+    finally:
+        await responder.stop()
+    res.update(
+        {
+            "accepted": len([qe for qe in queue if qe.is_complete(["127.0.0.1"])]),
+            "messages": responder.requests + responder.bad_tsig,
+            "dropped": responder.dropped,
+            "refused": responder.refused,
+            "bad_tsig": responder.bad_tsig,
+        }
+    )
+    return res
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="ddnsmulti benchmark suite")
+    parser.add_argument("--count", type=int, default=10000, help="Queue size")
+    parser.add_argument("--workers", type=int, default=1, help="Ingest workers")
+    parser.add_argument("--batch-size", type=int, default=1, help="Batch size")
+    parser.add_argument("--concurrency", type=int, default=32, help="Concurrency")
+    parser.add_argument("--connections", type=int, default=1, help="Connections")
+    parser.add_argument("--timeout", type=float, default=2, help="Query timeout")
+    parser.add_argument(
+        "--transport", choices=TRANSPORTS, default=DEFAULT_TRANSPORT, help="Transport"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0, help="Responder latency (seconds)"
+    )
+    parser.add_argument(
+        "--failure-rate", type=float, default=0, help="Fraction of requests dropped"
+    )
+    parser.add_argument(
+        "--refused-rate", type=float, default=0, help="Fraction of requests refused"
+    )
+    parser.add_argument("--output", metavar="filename", help="Write results as JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        queuedir = os.path.join(tmpdir, "queue")
+        os.mkdir(queuedir)
+        generate_queue(queuedir, args.count)
+
+        results["ingest"] = bench_ingest(queuedir, args.workers)
+        for index_format in INDEX_FORMATS:
+            results[f"index_{index_format}"] = bench_index(
+                queuedir, tmpdir, index_format
+            )
+
+        queue = ChangeRequestQueue(queue_directory=queuedir)
+        queue.update_queue()
+        results["build"] = bench_build(queue)
+        results["send"] = asyncio.run(bench_send(queue, args))
+
+    for name, result in results.items():
+        parts = [("", result)] if "rate" in result else result.items()
+        for part, values in parts:
+            label = f"{name} {part}".strip()
+            print(f"{label:20} {values['seconds']:8.3f}s {values['rate']:10.0f}/s")
+
+    if args.output:
+        report = {
+            "version": metadata.version("ddnsmulti"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.time(),
+            "parameters": vars(args),
+            "results": results,
+        }
+        with open(args.output, "wt") as output_file:
+            json.dump(report, output_file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
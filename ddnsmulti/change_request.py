@@ -1,7 +1,10 @@
+import json
 from dataclasses import dataclass
-from typing import List
+from functools import cached_property
+from typing import Callable, Dict, Iterator, List, Set, Tuple
 
 import dns.name
+import dns.rdata
 import dns.rdataclass
 import dns.rdatatype
 import dns.rrset
@@ -24,6 +27,7 @@ CR_SCHEMA = vol.Schema(
         vol.Required("zone"): DOMAIN_NAME,
         vol.Required("change"): DOMAIN_NAME,
         vol.Optional("ttl"): vol.All(int, vol.Range(min=0)),
+        vol.Optional("priority"): vol.All(int, vol.Range(min=0)),
         vol.Required("from"): RESOURCE_RECORDS_LIST,
         vol.Required("to"): RESOURCE_RECORDS_LIST,
     }
@@ -31,6 +35,12 @@ CR_SCHEMA = vol.Schema(
 
 DEFAULT_TTL = 86400
 
+# Change requests with lower priority values are sent first
+DEFAULT_PRIORITY = 10
+
+# Use libyaml if available
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
 ALLOWED_RDATATYPES = {
     dns.rdatatype.NS,
     dns.rdatatype.A,
@@ -54,6 +64,18 @@ class MissingGlueError(ChangeRequestError):
     pass
 
 
+RRsetKey = Tuple[dns.name.Name, dns.rdatatype.RdataType]
+RRsetIndex = Dict[RRsetKey, Set[dns.rdata.Rdata]]
+
+
+def index_rrsets(rrsets: List[dns.rrset.RRset]) -> RRsetIndex:
+    """Return rdata sets keyed by (owner name, rdatatype)"""
+    res: RRsetIndex = {}
+    for rrset in rrsets:
+        res.setdefault((rrset.name, rrset.rdtype), set()).update(rrset)
+    return res
+
+
 @dataclass(frozen=True)
 class ChangeRequest:
     zone: dns.name.Name
@@ -61,49 +83,64 @@ class ChangeRequest:
     ttl: int
     from_rrsets: List[dns.rrset.RRset]
     to_rrsets: List[dns.rrset.RRset]
+    priority: int = DEFAULT_PRIORITY
+
+    @cached_property
+    def from_index(self) -> RRsetIndex:
+        return index_rrsets(self.from_rrsets)
+
+    @cached_property
+    def to_index(self) -> RRsetIndex:
+        return index_rrsets(self.to_rrsets)
 
     def validate(self) -> None:
         if not self.change.is_subdomain(self.zone):
-            raise ValueError("{self.change} is not a subdomain of {self.zone}")
+            raise ValueError(f"{self.change} is not a subdomain of {self.zone}")
         self.validate_rrsets(self.from_rrsets)
         self.validate_rrsets(self.to_rrsets)
 
     def validate_rrsets(self, rrsets: List[dns.rrset.RRset]) -> None:
         """Ensure a RRset change set is valid"""
 
-        # check types
+        nameservers = set()
+        glue = set()
         for rrset in rrsets:
             if rrset.rdclass != dns.rdataclass.IN:
                 raise ValueError("rdataclass")
             if rrset.rdtype not in ALLOWED_RDATATYPES:
                 raise ValueError("rdatatype")
-
-        # check nameservers
-        nameservers = set()
-        for rrset in rrsets:
             if rrset.rdtype == dns.rdatatype.NS:
                 if rrset.name != self.change:
                     raise InvalidChangeError(f"Out of change NS: {rrset.name}")
                 nameservers.update([rdata.target for rdata in rrset])
+            else:
+                glue.add(rrset.name)
 
         # check for superflous glue
-        glue = set()
-        for rrset in rrsets:
-            if rrset.rdtype == dns.rdatatype.A or rrset.rdtype == dns.rdatatype.AAAA:
-                if rrset.name not in nameservers:
-                    raise SuperflousGlueError(f"Superflous glue: {rrset.name}")
-                glue.add(rrset.name)
+        if superflous := glue - nameservers:
+            raise SuperflousGlueError(f"Superflous glue: {min(superflous)}")
 
         # check for missing glue
-        for rrset in rrsets:
-            if rrset.rdtype == dns.rdatatype.NS:
-                for target in [rdata.target for rdata in rrset]:
-                    if target not in glue and target.is_subdomain(self.change):
-                        raise MissingGlueError(f"Missing glue for {target}")
+        if missing := set(
+            [
+                target
+                for target in nameservers - glue
+                if target.is_subdomain(self.change)
+            ]
+        ):
+            raise MissingGlueError(f"Missing glue for {min(missing)}")
 
     @classmethod
     def from_yaml(cls, yaml_str: str):
-        data = validate_with_humanized_errors(yaml.safe_load(yaml_str), CR_SCHEMA)
+        return cls.from_dict(yaml.load(yaml_str, Loader=YAML_LOADER))
+
+    @classmethod
+    def from_json(cls, json_str: str):
+        return cls.from_dict(json.loads(json_str))
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        data = validate_with_humanized_errors(data, CR_SCHEMA)
         zone = data["zone"]
         change = data["change"]
         ttl = data.get("ttl", DEFAULT_TTL)
@@ -115,26 +152,105 @@ class ChangeRequest:
             ttl=ttl,
             from_rrsets=from_rrsets,
             to_rrsets=to_rrsets,
+            priority=data.get("priority", DEFAULT_PRIORITY),
         )
         res.validate()
         return res
 
+    @classmethod
+    def from_wire(cls, data: dict):
+        """Rebuild CR from `to_wire` data, skipping validation"""
+        return cls(
+            zone=_name_from_wire(data["zone"]),
+            change=_name_from_wire(data["change"]),
+            ttl=data["ttl"],
+            from_rrsets=[_rrset_from_wire(rrset) for rrset in data["from"]],
+            to_rrsets=[_rrset_from_wire(rrset) for rrset in data["to"]],
+            priority=data["priority"],
+        )
+
+    def to_wire(self) -> dict:
+        """Return CR with names and RRsets in DNS wire format"""
+        return {
+            "zone": self.zone.to_wire(),
+            "change": self.change.to_wire(),
+            "ttl": self.ttl,
+            "priority": self.priority,
+            "from": [_rrset_to_wire(rrset) for rrset in self.from_rrsets],
+            "to": [_rrset_to_wire(rrset) for rrset in self.to_rrsets],
+        }
+
+    def to_dict(self) -> dict:
+        """Return CR in change request file format"""
+        return {
+            "zone": self.zone.to_text(),
+            "change": self.change.to_text(),
+            "ttl": self.ttl,
+            "priority": self.priority,
+            "from": _rrsets_to_text(self.from_rrsets),
+            "to": _rrsets_to_text(self.to_rrsets),
+        }
+
+    def to_yaml(self) -> str:
+        return yaml.safe_dump(self.to_dict(), sort_keys=False)
+
     def to_message(self) -> dns.update.UpdateMessage:
         """Return CR as DDNS message"""
 
         res = dns.update.UpdateMessage(self.zone)
+        self.add_to_message(res)
+        return res
+
+    def add_to_message(self, message: dns.update.UpdateMessage) -> None:
+        """Add CR prerequisites and updates to existing DDNS message
+
+        Only rdata not present in both the from and to RRsets are deleted or
+        added, unchanged rdata are left in place.
+        """
+
+        for rrset in self.from_rrsets:
+            message.present(rrset.name, rrset)
+
+        for rrset, rdatas in self._deleted():
+            message.delete(rrset.name, *rdatas)
+
+        for rrset, rdatas in self._added():
+            message.add(rrset.name, self.ttl, *rdatas)
 
+    def _deleted(self) -> Iterator[Tuple[dns.rrset.RRset, List[dns.rdata.Rdata]]]:
+        """Yield from RRsets with rdata not present in to RRsets"""
         for rrset in self.from_rrsets:
-            res.present(rrset.name, rrset)
-            if rrset not in self.to_rrsets:
-                res.delete(rrset.name, rrset)
+            keep = self.to_index.get((rrset.name, rrset.rdtype), set())
+            if rdatas := [rdata for rdata in rrset if rdata not in keep]:
+                yield (rrset, rdatas)
 
+    def _added(self) -> Iterator[Tuple[dns.rrset.RRset, List[dns.rdata.Rdata]]]:
+        """Yield to RRsets with rdata not present in from RRsets"""
         for rrset in self.to_rrsets:
-            rrset.ttl = self.ttl
-            if rrset not in self.from_rrsets:
-                res.add(rrset.name, rrset)
+            existing = self.from_index.get((rrset.name, rrset.rdtype), set())
+            if rdatas := [rdata for rdata in rrset if rdata not in existing]:
+                yield (rrset, rdatas)
+
+    def is_applied(self, rdatas: Callable[[RRsetKey], Set[dns.rdata.Rdata]]) -> bool:
+        """Return True if the zone contents given by `rdatas` match the CR result
+
+        RRsets only present in the to RRsets may hold additional rdata.
+        """
+        return all(
+            [rdatas(key) == self.to_index.get(key, set()) for key in self.from_index]
+        ) and all(
+            [
+                expected <= rdatas(key)
+                for key, expected in self.to_index.items()
+                if key not in self.from_index
+            ]
+        )
 
-        return res
+    def names(self) -> Set[dns.name.Name]:
+        """Return all owner names touched by CR"""
+        return set(
+            [name for name, _ in self.from_index] + [name for name, _ in self.to_index]
+        )
 
     def to_nsupdate(self) -> str:
         """Return CR as nsupdate instructions"""
@@ -143,26 +259,56 @@ class ChangeRequest:
         res.append(f"zone {self.zone}")
 
         for rrset in self.from_rrsets:
+            rrtext = f"{rrset.name} {_rrset_type_text(rrset)}"
             for rdata in rrset:
-                rdclass = dns.rdataclass.to_text(rrset.rdclass)
-                rdtype = dns.rdatatype.to_text(rrset.rdtype)
-                res.append(f"prereq yxrrset {rrset.name} {rdclass} {rdtype} {rdata}")
+                res.append(f"prereq yxrrset {rrtext} {rdata}")
 
-        for rrset in self.from_rrsets:
-            if rrset not in self.to_rrsets:
-                for rdata in rrset:
-                    rdclass = dns.rdataclass.to_text(rrset.rdclass)
-                    rdtype = dns.rdatatype.to_text(rrset.rdtype)
-                    res.append(f"update delete {rrset.name} {rdclass} {rdtype} {rdata}")
+        for rrset, rdatas in self._deleted():
+            rrtext = f"{rrset.name} {_rrset_type_text(rrset)}"
+            for rdata in rdatas:
+                res.append(f"update delete {rrtext} {rdata}")
 
-        for rrset in self.to_rrsets:
-            rrset.ttl = self.ttl
-            if rrset not in self.from_rrsets:
-                for rdata in rrset:
-                    rdclass = dns.rdataclass.to_text(rrset.rdclass)
-                    rdtype = dns.rdatatype.to_text(rrset.rdtype)
-                    res.append(
-                        f"update add {rrset.name} {rrset.ttl} {rdclass} {rdtype} {rdata}"
-                    )
+        for rrset, rdatas in self._added():
+            rrtext = f"{rrset.name} {self.ttl} {_rrset_type_text(rrset)}"
+            for rdata in rdatas:
+                res.append(f"update add {rrtext} {rdata}")
 
         return "\n".join(res)
+
+
+def _name_from_wire(wire: bytes) -> dns.name.Name:
+    return dns.name.from_wire(wire, 0)[0]
+
+
+def _rrset_to_wire(rrset: dns.rrset.RRset) -> list:
+    return [
+        rrset.name.to_wire(),
+        int(rrset.rdtype),
+        [rdata.to_wire() for rdata in rrset],
+    ]
+
+
+def _rrset_from_wire(data: list) -> dns.rrset.RRset:
+    name, rdtype, rdatas = data
+    return dns.rrset.from_rdata_list(
+        _name_from_wire(name),
+        0,
+        [
+            dns.rdata.from_wire(dns.rdataclass.IN, rdtype, wire, 0, len(wire))
+            for wire in rdatas
+        ],
+    )
+
+
+def _rrsets_to_text(rrsets: List[dns.rrset.RRset]) -> List[str]:
+    return [
+        f"{rrset.name} {dns.rdatatype.to_text(rrset.rdtype)} {rdata}"
+        for rrset in rrsets
+        for rdata in rrset
+    ]
+
+
+def _rrset_type_text(rrset: dns.rrset.RRset) -> str:
+    rdclass = dns.rdataclass.to_text(rrset.rdclass)
+    rdtype = dns.rdatatype.to_text(rrset.rdtype)
+    return f"{rdclass} {rdtype}"
@@ -1,8 +1,20 @@
 import argparse
 import logging
 
-from .commands import send_all_updates, send_single_update, show_queue, update_queue
+from .commands import (
+    convert_index,
+    run_sharded,
+    send_all_updates,
+    send_single_update,
+    shard_queue,
+    show_queue,
+    show_status,
+    update_queue,
+)
 from .config import UpdaterConfig
+from .daemon import run_daemon
+from .index import INDEX_FORMATS
+from .shards import SHARD_PLACEHOLDER
 
 DEFAULT_CONFIG_FILE = "ddnsmulti.yaml"
 
@@ -21,17 +33,57 @@ def main() -> None:
         "--nsupdate", action="store_true", help="Output nsupdate commands"
     )
     parser.add_argument("--debug", action="store_true", help="Enable debugging")
+    parser.add_argument(
+        "--shard", metavar="name", help="Only process a single shard of the queue"
+    )
 
     subparsers = parser.add_subparsers(dest="command", required=True)
 
     parser_show = subparsers.add_parser("show-queue", help="Show queue")
-    parser_show.set_defaults(func=show_queue)
+    parser_show.set_defaults(func=show_queue, sharded=True)
+    parser_show.add_argument(
+        "--nameserver",
+        metavar="address",
+        help="Only show entries pending for nameserver",
+    )
+
+    parser_status = subparsers.add_parser("status", help="Show nameserver backlog")
+    parser_status.set_defaults(func=show_status, sharded=True)
 
     parser_update = subparsers.add_parser("update-queue", help="Update queue")
-    parser_update.set_defaults(func=update_queue)
+    parser_update.set_defaults(func=update_queue, sharded=True)
 
     parser_send = subparsers.add_parser("send", help="Send all updates")
-    parser_send.set_defaults(func=send_all_updates)
+    parser_send.set_defaults(func=send_all_updates, sharded=True)
+    parser_send.add_argument(
+        "--workers",
+        metavar="N",
+        type=int,
+        default=1,
+        help="Send using N worker processes, each serving a share of the nameservers",
+    )
+
+    parser_daemon = subparsers.add_parser("daemon", help="Watch queue and send")
+    parser_daemon.set_defaults(func=run_daemon)
+
+    parser_shard = subparsers.add_parser(
+        "shard-queue", help="Move new files into queue shards"
+    )
+    parser_shard.set_defaults(func=shard_queue)
+
+    parser_convert = subparsers.add_parser(
+        "convert-index", help="Write index in another format"
+    )
+    parser_convert.set_defaults(func=convert_index, sharded=True)
+    parser_convert.add_argument(
+        "--format",
+        choices=sorted(INDEX_FORMATS),
+        required=True,
+        help="Index format to write",
+    )
+    parser_convert.add_argument(
+        "output", help=f"Index filename (may contain {SHARD_PLACEHOLDER})"
+    )
 
     parser_send = subparsers.add_parser("send-one", help="Send single update")
     parser_send.set_defaults(func=send_single_update)
@@ -46,6 +98,11 @@ def main() -> None:
 
     config = UpdaterConfig.from_file(args.config)
 
+    if args.shard and not config.shards:
+        parser.error("--shard requires a sharded queue")
+    if config.shards and getattr(args, "sharded", False):
+        return run_sharded(config, args)
+
     return args.func(config, args)
 
 
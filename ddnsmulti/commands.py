@@ -1,31 +1,73 @@
 import argparse
 import logging
-
-import dns.query
-import dns.tsig
+import os
+from typing import List
 
 from .config import UpdaterConfig
+from .index import get_index
+from .metrics import REGISTRY, update_queue_metrics
 from .queue import ChangeRequestQueue, ChangeRequestQueueEntry
+from .sender import send_entries
+from .shards import SHARD_PLACEHOLDER, distribute, list_shards
+from .workers import send_entries_parallel
 
 logger = logging.getLogger(__name__)
 
 
-def show_queue(config: UpdaterConfig, args: argparse.Namespace):
-    queue = ChangeRequestQueue(
-        queue_directory=config.queue_directory, index=config.index
+def get_queue(config: UpdaterConfig) -> ChangeRequestQueue:
+    return ChangeRequestQueue(
+        queue_directory=config.queue_directory,
+        index=config.index,
+        index_format=config.index_format,
+        nameservers=config.addresses,
+        workers=config.ingest_workers,
     )
+
+
+def outstanding(
+    config: UpdaterConfig, queue: ChangeRequestQueue
+) -> List[ChangeRequestQueueEntry]:
+    """Return entries to send or to verify"""
+    entries = queue.pending()
+    if addresses := config.verify_addresses:
+        pending = set([qe.filename for qe in entries])
+        entries += [
+            qe for qe in queue.unverified(addresses) if qe.filename not in pending
+        ]
+    return entries
+
+
+def show_queue(config: UpdaterConfig, args: argparse.Namespace):
+    queue = get_queue(config)
     if config.index:
         queue.load_index()
     queue.update_queue()
-    for qe in queue:
-        if qe:
-            print(f"- {qe.filename} ({qe.cr.change}) {qe.fingerprint}")
+    entries = queue.pending_for(args.nameserver) if args.nameserver else queue
+    for qe in entries:
+        print(f"- {qe.filename} ({qe.change}) {qe.fingerprint}")
+
+
+def show_status(config: UpdaterConfig, args: argparse.Namespace):
+    queue = get_queue(config)
+    if not config.index:
+        logger.error("No queue configured")
+        return -1
+    queue.load_index()
+    name = f"Shard {config.shard}" if config.shard else "Queue"
+    print(f"{name}: {len(queue)} entries, {len(queue.pending())} pending")
+    for address in config.addresses:
+        count, age = queue.lag(address)
+        if count:
+            status = f"{count} pending, oldest {age:.0f} seconds"
+        else:
+            status = "up to date"
+        if address in config.verify_addresses:
+            status += f", {len(queue.unverified([address]))} unverified"
+        print(f"- {address}: {status}")
 
 
 def update_queue(config: UpdaterConfig, args: argparse.Namespace):
-    queue = ChangeRequestQueue(
-        queue_directory=config.queue_directory, index=config.index
-    )
+    queue = get_queue(config)
     if not config.index:
         logger.error("No queue configured")
         return -1
@@ -33,14 +75,14 @@ def update_queue(config: UpdaterConfig, args: argparse.Namespace):
     queue.load_index()
     logger.info("Update index")
     queue.update_queue()
+    prune_queue(config, queue)
     queue.save_index()
     logger.info("Save index")
+    write_metrics(config, queue)
 
 
 def send_all_updates(config: UpdaterConfig, args: argparse.Namespace):
-    queue = ChangeRequestQueue(
-        queue_directory=config.queue_directory, index=config.index
-    )
+    queue = get_queue(config)
 
     if config.index:
         logger.info("Load index")
@@ -57,68 +99,83 @@ def send_all_updates(config: UpdaterConfig, args: argparse.Namespace):
             print("send")
             print()
     else:
-        for qe in queue:
-            send_queue_entry(config, args, qe)
+        entries = outstanding(config, queue)
+        if args.workers > 1:
+            send_entries_parallel(
+                config, entries, args.workers, debug=args.debug, queue=queue
+            )
+        else:
+            send_entries(config, entries, debug=args.debug, queue=queue)
 
     if config.index:
+        prune_queue(config, queue)
         logger.info("Save index")
         queue.save_index()
 
+    write_metrics(config, queue)
+
 
 def send_single_update(config: UpdaterConfig, args: argparse.Namespace):
     qe = ChangeRequestQueueEntry.from_file(args.filename)
-    send_queue_entry(config, args, qe)
-
-
-def send_queue_entry(
-    config: UpdaterConfig, args: argparse.Namespace, qe: ChangeRequestQueueEntry
-):
-    for nameserver in config.nameservers:
-        address = str(nameserver["address"])
-        if address not in qe.nameservers:
-            logger.info(
-                "%s (%s) scheduled for update via %s",
-                qe.filename,
-                qe.cr.change,
-                nameserver["address"],
-            )
-            update = qe.cr.to_message()
-
-            if args.debug:
-                print(str(update))
-
-            if tsig := nameserver.get("tsig"):
-                key = dns.tsig.Key(
-                    name=tsig["name"], secret=tsig["key"], algorithm=tsig["alg"]
-                )
-                update.use_tsig(keyring=key)
-            try:
-                response = dns.query.tcp(
-                    update, address, port=nameserver["port"], timeout=10
-                )
-                if response.rcode():
-                    qe.set_nameserver_incomplete(address)
-                    logger.warning(
-                        "%s (%s) not accepted by %s",
-                        qe.filename,
-                        qe.cr.change,
-                        address,
-                    )
-                else:
-                    qe.set_nameserver_complete(address)
-                    logger.info(
-                        "%s (%s) accepted by %s",
-                        qe.filename,
-                        qe.cr.change,
-                        address,
-                    )
-            except ConnectionRefusedError:
-                qe.set_nameserver_incomplete(address)
-                logger.warning(
-                    "%s (%s) connection refused by %s",
-                    qe.filename,
-                    qe.cr.change,
-                    address,
-                )
-        else:
-            logger.info("%s already processed, skipped", nameserver["address"])
+    send_entries(config, [qe], debug=args.debug)
+
+
+def prune_queue(config: UpdaterConfig, queue: ChangeRequestQueue):
+    if not config.archive:
+        return
+    if config.shard:
+        os.makedirs(config.archive["directory"], exist_ok=True)
+    if count := queue.prune(
+        nameservers=config.addresses,
+        archive_directory=config.archive["directory"],
+        max_age=config.archive.get("max_age"),
+        max_entries=config.archive.get("max_entries"),
+        verify=config.verify_addresses,
+    ):
+        logger.info("Archived %d completed entries", count)
+
+
+def write_metrics(config: UpdaterConfig, queue: ChangeRequestQueue):
+    if not config.metrics or not config.metrics.get("textfile"):
+        return
+    update_queue_metrics(queue, config.addresses)
+    REGISTRY.write_textfile(config.metrics["textfile"])
+
+
+def convert_index(config: UpdaterConfig, args: argparse.Namespace):
+    if not config.index:
+        logger.error("No queue configured")
+        return -1
+    output = args.output
+    if config.shard:
+        output = output.replace(SHARD_PLACEHOLDER, config.shard)
+    if os.path.exists(output):
+        logger.error("%s already exists", output)
+        return -1
+    queue = get_queue(config)
+    queue.load_index()
+    get_index(output, args.format).compact(queue)
+    logger.info("Wrote %d entries to %s (%s)", len(queue), output, args.format)
+
+
+def shard_queue(config: UpdaterConfig, args: argparse.Namespace):
+    if not config.shards:
+        logger.error("Queue is not sharded")
+        return -1
+    count = distribute(config.queue_directory, config.shards["layout"])
+    logger.info("Moved %d files to shards", count)
+
+
+def run_sharded(config: UpdaterConfig, args: argparse.Namespace):
+    """Run command for a single shard (--shard), or for each shard in turn
+
+    Metrics are reset for each shard, so that the metrics textfile of a shard
+    only covers that shard.
+    """
+    shards = [args.shard] if args.shard else list_shards(config.queue_directory)
+    res = None
+    for shard in shards:
+        logger.info("Shard %s", shard)
+        REGISTRY.clear()
+        res = args.func(config.for_shard(shard), args) or res
+    return res
@@ -1,7 +1,10 @@
 import base64
+import dataclasses
 import ipaddress
-from dataclasses import dataclass
-from typing import List, Optional
+import os
+from dataclasses import dataclass, field
+from functools import cached_property
+from typing import Dict, List, Optional
 
 import dns.name
 import dns.tsig
@@ -9,8 +12,57 @@ import voluptuous as vol
 import yaml
 from voluptuous.humanize import validate_with_humanized_errors
 
+from .connection import DEFAULT_TRANSPORT, TRANSPORTS, UDP_TIMEOUT
+from .index import DEFAULT_INDEX_FORMAT, INDEX_FORMATS
+from .metrics import DEFAULT_LISTEN
+from .queue import DEFAULT_INGEST_WORKERS
+from .retry import DEFAULT_BREAKER_THRESHOLD, DEFAULT_INITIAL_DELAY, DEFAULT_MAX_DELAY
+from .shards import DEFAULT_SHARD_LAYOUT, SHARD_LAYOUTS, SHARD_PLACEHOLDER
+from .watcher import DEFAULT_POLL_INTERVAL
+
 DOMAIN_NAME = dns.name.from_text
 
+DEFAULT_CONCURRENCY = 32
+DEFAULT_NAMESERVER_CONCURRENCY = 4
+DEFAULT_NAMESERVER_CONNECTIONS = 1
+DEFAULT_BATCH_SIZE = 1
+DEFAULT_RETRY_INTERVAL = 60
+DEFAULT_NAMESERVER_TIMEOUT = 10
+
+DAEMON_SCHEMA = vol.Schema(
+    {
+        vol.Optional("retry_interval", default=DEFAULT_RETRY_INTERVAL): vol.All(
+            vol.Coerce(float), vol.Range(min=0, min_included=False)
+        ),
+        vol.Optional("poll_interval", default=DEFAULT_POLL_INTERVAL): vol.All(
+            vol.Coerce(float), vol.Range(min=0, min_included=False)
+        ),
+        vol.Optional("watch", default="auto"): vol.Any("auto", "inotify", "poll"),
+    }
+)
+
+RETRY_SCHEMA = vol.Schema(
+    {
+        vol.Optional("initial_delay", default=DEFAULT_INITIAL_DELAY): vol.All(
+            vol.Coerce(float), vol.Range(min=0)
+        ),
+        vol.Optional("max_delay", default=DEFAULT_MAX_DELAY): vol.All(
+            vol.Coerce(float), vol.Range(min=0)
+        ),
+        vol.Optional("breaker_threshold", default=DEFAULT_BREAKER_THRESHOLD): vol.All(
+            int, vol.Range(min=1)
+        ),
+    }
+)
+
+METRICS_SCHEMA = vol.Schema(
+    {
+        vol.Optional("listen", default=DEFAULT_LISTEN): str,
+        vol.Optional("port"): vol.All(int, vol.Range(min=0, max=65535)),
+        vol.Optional("textfile"): str,
+    }
+)
+
 TSIG_ALGORITHMS = {
     "hmac-sha1",
     "hmac-sha224",
@@ -26,11 +78,57 @@ CONFIG_SCHEMA = vol.Schema(
     {
         vol.Required("queuedir"): vol.IsDir(),
         vol.Optional("index"): str,
+        vol.Optional("index_format", default=DEFAULT_INDEX_FORMAT): vol.Any(
+            *INDEX_FORMATS
+        ),
+        vol.Optional("concurrency", default=DEFAULT_CONCURRENCY): vol.All(
+            int, vol.Range(min=1)
+        ),
+        vol.Optional("ingest_workers", default=DEFAULT_INGEST_WORKERS): vol.All(
+            int, vol.Range(min=1)
+        ),
+        vol.Optional("batch_size", default=DEFAULT_BATCH_SIZE): vol.All(
+            int, vol.Range(min=1)
+        ),
+        vol.Optional("archive"): vol.Schema(
+            {
+                vol.Required("directory"): vol.IsDir(),
+                vol.Optional("max_age"): vol.All(vol.Coerce(float), vol.Range(min=0)),
+                vol.Optional("max_entries"): vol.All(int, vol.Range(min=0)),
+            }
+        ),
+        vol.Optional("daemon", default={}): DAEMON_SCHEMA,
+        vol.Optional("retry", default={}): RETRY_SCHEMA,
+        vol.Optional("metrics"): METRICS_SCHEMA,
+        vol.Optional("shards"): vol.Schema(
+            {
+                vol.Optional("layout", default=DEFAULT_SHARD_LAYOUT): vol.Any(
+                    *SHARD_LAYOUTS
+                ),
+            }
+        ),
         vol.Required("nameservers"): [
             vol.Schema(
                 {
                     vol.Required("address"): ipaddress.ip_address,
                     vol.Optional("port", default=53): int,
+                    vol.Optional(
+                        "concurrency", default=DEFAULT_NAMESERVER_CONCURRENCY
+                    ): vol.All(int, vol.Range(min=1)),
+                    vol.Optional(
+                        "connections", default=DEFAULT_NAMESERVER_CONNECTIONS
+                    ): vol.All(int, vol.Range(min=1)),
+                    vol.Optional("preflight", default=False): bool,
+                    vol.Optional("verify", default=False): bool,
+                    vol.Optional("transport", default=DEFAULT_TRANSPORT): vol.Any(
+                        *TRANSPORTS
+                    ),
+                    vol.Optional(
+                        "timeout", default=DEFAULT_NAMESERVER_TIMEOUT
+                    ): vol.All(vol.Coerce(float), vol.Range(min=0, min_included=False)),
+                    vol.Optional("udp_timeout", default=UDP_TIMEOUT): vol.All(
+                        vol.Coerce(float), vol.Range(min=0, min_included=False)
+                    ),
                     vol.Optional("tsig"): vol.Schema(
                         {
                             vol.Required("name"): DOMAIN_NAME,
@@ -45,19 +143,124 @@ CONFIG_SCHEMA = vol.Schema(
 )
 
 
+@dataclass(frozen=True)
+class NameserverContext:
+    """Parameters for sending to a nameserver, built once per configuration"""
+
+    address: str
+    port: int
+    transport: str
+    timeout: float
+    udp_timeout: float = UDP_TIMEOUT
+    key: Optional[dns.tsig.Key] = None
+
+    @classmethod
+    def from_dict(cls, nameserver: dict):
+        key = None
+        if tsig := nameserver.get("tsig"):
+            key = dns.tsig.Key(
+                name=tsig["name"], secret=tsig["key"], algorithm=tsig["alg"]
+            )
+        return cls(
+            address=str(nameserver["address"]),
+            port=nameserver["port"],
+            transport=nameserver["transport"],
+            timeout=nameserver["timeout"],
+            udp_timeout=nameserver["udp_timeout"],
+            key=key,
+        )
+
+
 @dataclass(frozen=True)
 class UpdaterConfig:
     index: Optional[str]
     queue_directory: str
     nameservers: List[dict]
+    concurrency: int = DEFAULT_CONCURRENCY
+    batch_size: int = DEFAULT_BATCH_SIZE
+    index_format: str = DEFAULT_INDEX_FORMAT
+    archive: Optional[dict] = None
+    metrics: Optional[dict] = None
+    shards: Optional[dict] = None
+    shard: Optional[str] = None
+    ingest_workers: int = DEFAULT_INGEST_WORKERS
+    daemon: dict = field(default_factory=lambda: DAEMON_SCHEMA({}))
+    retry: dict = field(default_factory=lambda: RETRY_SCHEMA({}))
+
+    @property
+    def addresses(self) -> List[str]:
+        return [str(nameserver["address"]) for nameserver in self.nameservers]
+
+    @cached_property
+    def contexts(self) -> Dict[str, NameserverContext]:
+        """Return send contexts of nameservers, keyed by address"""
+        return {
+            str(nameserver["address"]): NameserverContext.from_dict(nameserver)
+            for nameserver in self.nameservers
+        }
+
+    @property
+    def verify_addresses(self) -> List[str]:
+        """Return addresses of nameservers with verification enabled"""
+        return [
+            str(nameserver["address"])
+            for nameserver in self.nameservers
+            if nameserver["verify"]
+        ]
+
+    def for_shard(self, shard: str):
+        """Return configuration for a single shard of the queue
+
+        The shard's queue directory is a subdirectory of the queue directory,
+        and `{shard}` in the index and metrics textfile names is replaced by
+        the shard name. Archived entries are kept in a subdirectory of the
+        archive directory.
+        """
+        if not self.shards:
+            raise ValueError("Queue is not sharded")
+        metrics = self.metrics
+        if metrics and metrics.get("textfile"):
+            metrics = {
+                **metrics,
+                "textfile": metrics["textfile"].replace(SHARD_PLACEHOLDER, shard),
+            }
+        archive = self.archive
+        if archive:
+            archive = {
+                **archive,
+                "directory": os.path.join(archive["directory"], shard),
+            }
+        return dataclasses.replace(
+            self,
+            queue_directory=os.path.join(self.queue_directory, shard),
+            index=self.index.replace(SHARD_PLACEHOLDER, shard) if self.index else None,
+            metrics=metrics,
+            archive=archive,
+            shard=shard,
+        )
 
     @classmethod
     def from_yaml(cls, yaml_str: str):
         config = validate_with_humanized_errors(yaml.safe_load(yaml_str), CONFIG_SCHEMA)
+        if (
+            config.get("shards")
+            and config.get("index")
+            and SHARD_PLACEHOLDER not in config["index"]
+        ):
+            raise vol.Invalid(f"index must contain {SHARD_PLACEHOLDER} with shards")
         return cls(
             index=config.get("index"),
             queue_directory=config["queuedir"],
             nameservers=config["nameservers"],
+            concurrency=config["concurrency"],
+            batch_size=config["batch_size"],
+            index_format=config["index_format"],
+            archive=config.get("archive"),
+            metrics=config.get("metrics"),
+            shards=config.get("shards"),
+            daemon=config["daemon"],
+            retry=config["retry"],
+            ingest_workers=config["ingest_workers"],
         )
 
     @classmethod
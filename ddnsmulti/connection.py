@@ -0,0 +1,329 @@
+import asyncio
+import itertools
+import logging
+import random
+import struct
+import time
+from typing import Dict, List, Optional, Tuple
+
+import dns.exception
+import dns.flags
+import dns.message
+import dns.query
+import dns.tsig
+
+from .wire import sign_wire, signed_size
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONNECT_TIMEOUT = 10
+BACKOFF_INITIAL = 0.5
+BACKOFF_MAX = 30
+
+TRANSPORTS = ["tcp", "udp", "auto"]
+DEFAULT_TRANSPORT = "tcp"
+
+# Largest signed message sent over UDP in auto mode, and default time to wait
+# for a UDP response before falling back to TCP
+UDP_MAX_SIZE = 1232
+UDP_TIMEOUT = 2
+
+
+class _QueryMatcher:
+    """Outstanding queries, matched to responses by message ID"""
+
+    def __init__(self, address: str) -> None:
+        self.address = address
+        self._pending: Dict[
+            int, Tuple[Optional[dns.tsig.Key], Optional[bytes], asyncio.Future]
+        ] = {}
+
+    def _allocate_id(self) -> int:
+        while True:
+            qid = random.randint(0, 65535)
+            if qid not in self._pending:
+                return qid
+
+    def _dispatch(self, wire: bytes) -> None:
+        (qid,) = struct.unpack("!H", wire[:2])
+        if qid not in self._pending:
+            logger.debug("Unexpected response id %d from %s", qid, self.address)
+            return
+        key, request_mac, future = self._pending[qid]
+        if future.done():
+            return
+        try:
+            response = dns.message.from_wire(
+                wire, keyring=key, request_mac=request_mac or b""
+            )
+            if not response.flags & dns.flags.QR:
+                raise dns.query.BadResponse
+            if response.flags & dns.flags.TC:
+                raise dns.message.Truncated(message=response)
+        except Exception as exc:
+            future.set_exception(exc)
+        else:
+            future.set_result(response)
+
+
+class NameserverConnection(_QueryMatcher):
+    """Persistent TCP connection to a nameserver
+
+    Several messages may be outstanding on the connection at the same time,
+    responses are matched to requests by message ID. The connection is
+    (re)established on demand. Failed connection attempts are retried with
+    exponential backoff; during backoff, queries fail immediately.
+    """
+
+    def __init__(
+        self,
+        address: str,
+        port: int = 53,
+        connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+    ) -> None:
+        super().__init__(address)
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._connect_lock = asyncio.Lock()
+        self._write_lock = asyncio.Lock()
+        self._backoff = 0.0
+        self._retry_at = 0.0
+        self._last_error: Optional[Exception] = None
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def connect(self) -> None:
+        async with self._connect_lock:
+            if self.connected:
+                return
+            if (delay := self._retry_at - time.monotonic()) > 0:
+                raise ConnectionError(
+                    f"Connection to {self.address} failed, retry in {delay:.1f}s"
+                ) from self._last_error
+            try:
+                self._reader, self._writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.address, self.port),
+                    self.connect_timeout,
+                )
+            except (OSError, asyncio.TimeoutError) as exc:
+                self._backoff = min(
+                    max(self._backoff * 2, BACKOFF_INITIAL), BACKOFF_MAX
+                )
+                self._retry_at = time.monotonic() + self._backoff
+                self._last_error = exc
+                logger.debug(
+                    "Connection to %s port %d failed, backoff %.1fs",
+                    self.address,
+                    self.port,
+                    self._backoff,
+                )
+                raise
+            self._backoff = 0.0
+            self._retry_at = 0.0
+            self._last_error = None
+            self._reader_task = asyncio.create_task(self._read_responses())
+            logger.debug("Connected to %s port %d", self.address, self.port)
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except OSError:
+                pass
+        if self._reader_task is not None:
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+            self._reader_task = None
+        self._writer = None
+        self._reader = None
+
+    async def query(
+        self, wire: bytes, key: Optional[dns.tsig.Key], timeout: float
+    ) -> dns.message.Message:
+        """Send unsigned message in wire format and wait for the matching response
+
+        The message is given a new message ID and signed using key (if any).
+        """
+
+        await self.connect()
+
+        qid = self._allocate_id()
+        signed_wire, request_mac = sign_wire(wire, qid, key)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[qid] = (key, request_mac, future)
+        try:
+            async with self._write_lock:
+                self._writer.write(struct.pack("!H", len(signed_wire)) + signed_wire)
+                await self._writer.drain()
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise dns.exception.Timeout(timeout=timeout) from None
+        finally:
+            self._pending.pop(qid, None)
+
+    async def _read_responses(self) -> None:
+        reader, writer = self._reader, self._writer
+        error: Exception = ConnectionResetError(f"Connection closed by {self.address}")
+        try:
+            while True:
+                (length,) = struct.unpack("!H", await reader.readexactly(2))
+                wire = await reader.readexactly(length)
+                self._dispatch(wire)
+        except asyncio.IncompleteReadError:
+            pass
+        except OSError as exc:
+            error = exc
+        finally:
+            writer.close()
+            for _, _, future in self._pending.values():
+                if not future.done():
+                    future.set_exception(error)
+
+
+class DatagramConnection(_QueryMatcher):
+    """UDP socket to a nameserver
+
+    Several messages may be outstanding at the same time, responses are
+    matched to requests by message ID. Truncated responses raise
+    `dns.message.Truncated`.
+    """
+
+    def __init__(self, address: str, port: int = 53) -> None:
+        super().__init__(address)
+        self.port = port
+        self._transport: Optional[asyncio.DatagramTransport] = None
+        self._connect_lock = asyncio.Lock()
+
+    async def connect(self) -> None:
+        async with self._connect_lock:
+            if self._transport is not None and not self._transport.is_closing():
+                return
+            loop = asyncio.get_running_loop()
+            self._transport, _ = await loop.create_datagram_endpoint(
+                lambda: _DatagramProtocol(self), remote_addr=(self.address, self.port)
+            )
+
+    async def close(self) -> None:
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+
+    async def query(
+        self, wire: bytes, key: Optional[dns.tsig.Key], timeout: float
+    ) -> dns.message.Message:
+        """Send unsigned message in wire format and wait for the matching response"""
+
+        await self.connect()
+
+        qid = self._allocate_id()
+        signed_wire, request_mac = sign_wire(wire, qid, key)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[qid] = (key, request_mac, future)
+        try:
+            self._transport.sendto(signed_wire)
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise dns.exception.Timeout(timeout=timeout) from None
+        finally:
+            self._pending.pop(qid, None)
+
+    def _connection_lost(self, exc: Optional[Exception]) -> None:
+        """Fail all outstanding queries"""
+        error = exc or ConnectionResetError(f"Socket to {self.address} closed")
+        for _, _, future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, connection: DatagramConnection) -> None:
+        self.connection = connection
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        if len(data) >= 2:
+            self.connection._dispatch(data)
+
+    def error_received(self, exc: Exception) -> None:
+        logger.debug("UDP error from %s: %s", self.connection.address, str(exc))
+        self.connection._connection_lost(exc)
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self.connection._connection_lost(exc)
+
+
+class ConnectionPool:
+    """Connections to a nameserver
+
+    With the `tcp` transport, updates are sent over a pool of persistent TCP
+    connections used round-robin. With `udp`, updates are sent over UDP
+    only. With `auto`, updates are sent over UDP if the signed message fits
+    in `UDP_MAX_SIZE` bytes, and resent over TCP if the response is
+    truncated or does not arrive within `udp_timeout` seconds.
+    """
+
+    def __init__(
+        self,
+        address: str,
+        port: int = 53,
+        size: int = 1,
+        transport: str = DEFAULT_TRANSPORT,
+        udp_timeout: float = UDP_TIMEOUT,
+    ) -> None:
+        if transport not in TRANSPORTS:
+            raise ValueError(f"Unknown transport: {transport}")
+        self.address = address
+        self.port = port
+        self.transport = transport
+        self.udp_timeout = udp_timeout
+        self.connections: List[NameserverConnection] = [
+            NameserverConnection(address, port) for _ in range(size)
+        ]
+        self.datagram = DatagramConnection(address, port)
+        self._next = itertools.cycle(self.connections)
+
+    async def query(
+        self, wire: bytes, key: Optional[dns.tsig.Key], timeout: float
+    ) -> dns.message.Message:
+        response, _ = await self.update(wire, key, timeout)
+        return response
+
+    async def update(
+        self, wire: bytes, key: Optional[dns.tsig.Key], timeout: float
+    ) -> Tuple[dns.message.Message, bool]:
+        """Send message, returning response and whether it was resent
+
+        A message is resent over TCP when no UDP response arrived. As the
+        nameserver may have applied the first copy of an UPDATE, a failed
+        prerequisite in the response to a resent UPDATE does not mean that
+        the update was not applied.
+        """
+
+        if self.transport == "udp":
+            return (await self.datagram.query(wire, key, timeout), False)
+        resent = False
+        if self.transport == "auto" and signed_size(wire, key) <= UDP_MAX_SIZE:
+            try:
+                return (
+                    await self.datagram.query(
+                        wire, key, min(timeout, self.udp_timeout)
+                    ),
+                    False,
+                )
+            except (dns.message.Truncated, dns.exception.Timeout) as exc:
+                resent = isinstance(exc, dns.exception.Timeout)
+                logger.debug(
+                    "No usable UDP response from %s (%s), using TCP",
+                    self.address,
+                    exc.__class__.__name__,
+                )
+        return (await next(self._next).query(wire, key, timeout), resent)
+
+    async def close(self) -> None:
+        await asyncio.gather(
+            self.datagram.close(), *[c.close() for c in self.connections]
+        )
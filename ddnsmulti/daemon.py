@@ -0,0 +1,147 @@
+import argparse
+import asyncio
+import logging
+import signal
+from typing import Optional, Set
+
+from .commands import get_queue, outstanding, prune_queue, write_metrics
+from .config import UpdaterConfig
+from .metrics import MetricsServer, update_queue_metrics
+from .sender import UpdateSender
+from .watcher import start_watcher
+
+logger = logging.getLogger(__name__)
+
+
+class UpdaterDaemon:
+    """Long-running updater
+
+    New files in the queue directory are picked up as they arrive and sent to
+    all nameservers immediately. Entries not accepted by all nameservers are
+    retried every `retry_interval` seconds. The queue is kept in memory and
+    the index is saved after every send.
+    """
+
+    def __init__(self, config: UpdaterConfig, debug: bool = False) -> None:
+        self.config = config
+        self.debug = debug
+        self.queue = get_queue(config)
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._retry = True
+        self._rescan = True
+        self._new_files: Set[str] = set()
+
+    def stop(self) -> None:
+        logger.info("Shutting down")
+        self._stopping = True
+        self._wakeup.set()
+
+    def files_changed(self, filenames: Optional[Set[str]]) -> None:
+        if filenames is None:
+            self._rescan = True
+        else:
+            self._new_files.update(filenames)
+        self._wakeup.set()
+
+    async def _retry_timer(self) -> None:
+        while True:
+            await asyncio.sleep(self.config.daemon["retry_interval"])
+            self._retry = True
+            self._wakeup.set()
+
+    def ingest(self) -> list:
+        """Add new files to queue, return new entries
+
+        Pending entries changing the same names as new entries are returned
+        with them, so that the sender keeps them in queue order.
+        """
+        if self._rescan:
+            self._rescan = False
+            self._new_files = set()
+            self.queue.update_queue()
+            return outstanding(self.config, self.queue)
+        entries = []
+        for filename in sorted(self._new_files):
+            entries.extend(self.queue.ingest_file(filename))
+        self._new_files = set()
+        names = set([qe.change for qe in entries])
+        new = set([qe.filename for qe in entries])
+        return [
+            qe
+            for qe in self.queue.pending()
+            if qe.change in names and qe.filename not in new
+        ] + entries
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(signum, self.stop)
+
+        if self.config.index:
+            logger.info("Load index")
+            self.queue.load_index()
+
+        metrics_server = None
+        watcher = None
+        retry_timer = None
+        try:
+            if self.config.metrics and "port" in self.config.metrics:
+                metrics_server = MetricsServer(
+                    self.config.metrics["listen"],
+                    self.config.metrics["port"],
+                    collect=lambda: update_queue_metrics(
+                        self.queue, self.config.addresses
+                    ),
+                )
+                await metrics_server.start()
+
+            watcher = start_watcher(
+                self.config.queue_directory,
+                self.files_changed,
+                method=self.config.daemon["watch"],
+                interval=self.config.daemon["poll_interval"],
+            )
+            retry_timer = asyncio.create_task(self._retry_timer())
+            self._wakeup.set()
+            logger.info("Watching %s", self.config.queue_directory)
+
+            async with UpdateSender(
+                self.config, debug=self.debug, queue=self.queue
+            ) as sender:
+                while not self._stopping:
+                    await self._wakeup.wait()
+                    self._wakeup.clear()
+                    if self._stopping:
+                        break
+                    entries = self.ingest()
+                    if self._retry:
+                        self._retry = False
+                        entries = outstanding(self.config, self.queue)
+                        prune_queue(self.config, self.queue)
+                    if entries:
+                        await sender.send(entries)
+                    if self.config.index:
+                        self.queue.save_index()
+                    write_metrics(self.config, self.queue)
+        finally:
+            if retry_timer is not None:
+                retry_timer.cancel()
+            if watcher is not None:
+                watcher.close()
+            if metrics_server is not None:
+                await metrics_server.close()
+            if self.config.index:
+                logger.info("Save index")
+                self.queue.save_index()
+            for signum in [signal.SIGINT, signal.SIGTERM]:
+                loop.remove_signal_handler(signum)
+
+
+def run_daemon(config: UpdaterConfig, args: argparse.Namespace):
+    if config.shards:
+        if not args.shard:
+            logger.error("A shard must be given (--shard) for a sharded queue")
+            return -1
+        config = config.for_shard(args.shard)
+    asyncio.run(UpdaterDaemon(config, debug=args.debug).run())
@@ -0,0 +1,371 @@
+import fcntl
+import json
+import logging
+import os
+import tempfile
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+INDEX_FORMATS = {"json", "journal", "msgpack"}
+DEFAULT_INDEX_FORMAT = "json"
+
+JOURNAL_SUFFIX = ".journal"
+JOURNAL_COMPACT_MIN = 1000
+
+LOCK_SUFFIX = ".lock"
+
+
+class QueueIndexError(ValueError):
+    pass
+
+
+@contextmanager
+def index_lock(filename: str, exclusive: bool = False) -> Iterator[None]:
+    """Hold an advisory lock on index (using a separate lock file)"""
+    with open(filename + LOCK_SUFFIX, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def write_atomic(filename: str, data: Union[str, bytes]) -> None:
+    """Replace file with data (via a synced temporary file and rename)"""
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_filename = tempfile.mkstemp(
+        dir=directory, prefix=os.path.basename(filename) + ".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb" if isinstance(data, bytes) else "wt") as output_file:
+            output_file.write(data)
+            output_file.flush()
+            os.fsync(output_file.fileno())
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        try:
+            os.unlink(tmp_filename)
+        except OSError:
+            pass
+        raise
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def file_signature(filename: str) -> Optional[Tuple[int, int, int]]:
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+def apply_change(
+    entries: Dict[str, dict], breakers: Dict[str, float], record: dict
+) -> None:
+    """Apply a single change record to entries, keyed by filename, and breakers"""
+    op = record["op"]
+    if op == "add":
+        entries[record["entry"]["filename"]] = record["entry"]
+    elif op == "remove":
+        entries.pop(record["filename"], None)
+    elif op == "status":
+        if entry := entries.get(record["filename"]):
+            entry["nameservers"][record["nameserver"]] = record["value"]
+            if retry := record.get("retry"):
+                entry.setdefault("retries", {})[record["nameserver"]] = retry
+            else:
+                entry.get("retries", {}).pop(record["nameserver"], None)
+            entry.get("verified", {}).pop(record["nameserver"], None)
+    elif op == "verified":
+        if entry := entries.get(record["filename"]):
+            entry.setdefault("verified", {})[record["nameserver"]] = record["value"]
+    elif op == "stat":
+        if entry := entries.get(record["filename"]):
+            entry["stat"] = record["stat"]
+    elif op == "breaker":
+        if record["value"] is None:
+            breakers.pop(record["nameserver"], None)
+        else:
+            breakers[record["nameserver"]] = record["value"]
+    else:
+        raise QueueIndexError(f"Unknown journal operation: {op}")
+
+
+def merge_changes(
+    entries: Dict[str, dict], breakers: Dict[str, float], changes: List[dict]
+) -> List[dict]:
+    """Apply changes made by this process to entries saved by another process
+
+    A nameserver accepting an entry is never undone by a failure recorded by
+    another process, and an entry added by both processes keeps the
+    nameservers that already accepted it. Returns the changes applied.
+    """
+    res = []
+    for record in changes:
+        if record["op"] == "breaker":
+            existing = None
+        else:
+            existing = entries.get(
+                record.get("filename") or record["entry"]["filename"]
+            )
+        if record["op"] == "add" and existing is not None:
+            entry = record["entry"]
+            if entry["fingerprint"] == existing["fingerprint"]:
+                nameservers = dict(entry["nameservers"])
+                for address, value in existing["nameservers"].items():
+                    if value is not None:
+                        nameservers[address] = value
+                record = {"op": "add", "entry": {**entry, "nameservers": nameservers}}
+        elif record["op"] == "status" and existing is not None:
+            if record["value"] is None:
+                if existing["nameservers"].get(record["nameserver"]) is not None:
+                    continue
+        apply_change(entries, breakers, record)
+        res.append(record)
+    return res
+
+
+class JsonIndex:
+    """Index stored as a single JSON document, rewritten on every save
+
+    If the index was saved by another process since it was loaded, the
+    changes made by this process are merged into the saved index. Besides
+    the entries, the index holds the time until which the circuit breaker of
+    each nameserver is open (`breakers`), set by `load`.
+    """
+
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self.signature = None
+        self.breakers: Dict[str, float] = {}
+
+    def load(self) -> List[dict]:
+        with index_lock(self.filename):
+            self.signature = file_signature(self.filename)
+            data = self._read()
+        self.breakers = data.get("breakers", {})
+        return data["queue"]
+
+    def _read(self) -> dict:
+        try:
+            with open(self.filename) as idx:
+                return json.load(idx)
+        except FileNotFoundError:
+            return {"queue": []}
+
+    def save(self, queue, changes: List[dict]) -> bool:
+        """Save index, return True if changes were merged into a newer index"""
+        with index_lock(self.filename, exclusive=True):
+            merged = file_signature(self.filename) != self.signature
+            if merged:
+                logger.info("Index saved by another process, merging changes")
+                data = self._read()
+                entries = {entry["filename"]: entry for entry in data["queue"]}
+                breakers = data.get("breakers", {})
+                merge_changes(entries, breakers, changes)
+                data = {"queue": list(entries.values()), "breakers": breakers}
+            else:
+                data = self._snapshot(queue)
+            self._write(data)
+            self.signature = file_signature(self.filename)
+        return merged
+
+    def _snapshot(self, queue) -> dict:
+        return queue.as_dict()
+
+    def _write(self, data: dict) -> None:
+        write_atomic(self.filename, json.dumps(data, indent=4))
+
+    def compact(self, queue) -> None:
+        """Write queue to a new index"""
+        self.signature = file_signature(self.filename)
+        self.save(queue, [])
+
+
+class MsgpackIndex(JsonIndex):
+    """Index stored as a single MessagePack document, rewritten on every save
+
+    Change requests are stored in DNS wire format rather than as YAML, so
+    entries are loaded without parsing and validating the YAML payload. The
+    YAML fingerprint is kept for provenance. Entries merged from changes of
+    another process keep their YAML payload until the next save.
+    """
+
+    def _read(self) -> dict:
+        try:
+            with open(self.filename, "rb") as idx:
+                return msgpack.unpackb(idx.read())
+        except FileNotFoundError:
+            return {"queue": []}
+
+    def _snapshot(self, queue) -> dict:
+        return queue.as_dict(wire=True)
+
+    def _write(self, data: dict) -> None:
+        write_atomic(self.filename, msgpack.packb(data))
+
+
+class JournalIndex:
+    """Index stored as a JSON snapshot and an append-only journal of changes
+
+    The snapshot uses the same format as `JsonIndex`. Each save appends the
+    changes made since the last save to the journal, one JSON record per
+    line. When the journal grows larger than the queue itself, the journal is
+    compacted into a new snapshot. Changes are merged as for `JsonIndex` if
+    another process saved the index since it was loaded.
+
+    Each snapshot has a generation number, and the journal starts with the
+    generation of the snapshot it applies to. A journal left behind by a
+    compaction interrupted after writing the new snapshot is thereby ignored.
+    A record torn by an interrupted save is dropped from the journal before
+    the next records are appended.
+
+    Journal records:
+
+        {"op": "generation", "generation": ...}
+        {"op": "add", "entry": {...}}
+        {"op": "remove", "filename": ...}
+        {"op": "status", "filename": ..., "nameserver": ..., "value": ...,
+         "retry": [attempts, next_attempt] or null}
+        {"op": "stat", "filename": ..., "stat": [size, mtime_ns, inode]}
+        {"op": "verified", "filename": ..., "nameserver": ..., "value": ...}
+        {"op": "breaker", "nameserver": ..., "value": open_until or null}
+    """
+
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self.journal_filename = filename + JOURNAL_SUFFIX
+        self.journal_records = 0
+        self.journal_size = 0
+        self.generation = 0
+        self.signature = None
+        self.breakers: Dict[str, float] = {}
+
+    def _signature(self):
+        return (file_signature(self.filename), file_signature(self.journal_filename))
+
+    def load(self) -> List[dict]:
+        with index_lock(self.filename):
+            self.signature = self._signature()
+            return list(self._read().values())
+
+    def _read(self) -> Dict[str, dict]:
+        entries: Dict[str, dict] = {}
+        self.breakers = {}
+        self.generation = 0
+        try:
+            with open(self.filename) as idx:
+                data = json.load(idx)
+            for entry in data["queue"]:
+                entries[entry["filename"]] = entry
+            self.breakers = data.get("breakers", {})
+            self.generation = data.get("generation", 0)
+        except FileNotFoundError:
+            pass
+
+        self.journal_records = 0
+        self.journal_size = 0
+        # records written before generations were introduced have none
+        generation = 0
+        try:
+            with open(self.journal_filename, "rb") as journal:
+                for line in journal:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("Incomplete line")
+                        record = json.loads(line) if line.strip() else None
+                    except ValueError:
+                        logger.warning("Ignoring truncated journal record")
+                        break
+                    if record is not None and record["op"] == "generation":
+                        generation = record["generation"]
+                    elif record is not None and generation != self.generation:
+                        logger.warning("Ignoring journal of an older snapshot")
+                        self.journal_size = 0
+                        self.journal_records = 0
+                        break
+                    elif record is not None:
+                        self.apply(entries, self.breakers, record)
+                        self.journal_records += 1
+                    self.journal_size += len(line)
+        except FileNotFoundError:
+            pass
+
+        return entries
+
+    apply = staticmethod(apply_change)
+
+    def save(self, queue, changes: List[dict]) -> bool:
+        """Save index, return True if changes were merged into a newer index"""
+        with index_lock(self.filename, exclusive=True):
+            merged = self._signature() != self.signature
+            if merged:
+                logger.info("Index saved by another process, merging changes")
+                entries = self._read()
+                changes = merge_changes(entries, self.breakers, changes)
+                size = len(entries)
+            else:
+                size = len(queue)
+            if self.journal_records + len(changes) > max(JOURNAL_COMPACT_MIN, size):
+                self._compact(
+                    {"queue": list(entries.values()), "breakers": self.breakers}
+                    if merged
+                    else queue.as_dict()
+                )
+            elif changes:
+                self._append(changes)
+            self.signature = self._signature()
+        return merged
+
+    def compact(self, queue) -> None:
+        """Write queue to a new snapshot and truncate the journal"""
+        with index_lock(self.filename, exclusive=True):
+            self._compact(queue.as_dict())
+            self.signature = self._signature()
+
+    def _append(self, changes: List[dict]) -> None:
+        """Append records to journal, after the last complete record"""
+        records = changes
+        if self.journal_size == 0:
+            records = [{"op": "generation", "generation": self.generation}] + records
+        data = "".join([json.dumps(record) + "\n" for record in records]).encode()
+        with open(self.journal_filename, "ab") as journal:
+            journal.truncate(self.journal_size)
+            journal.write(data)
+            journal.flush()
+            os.fsync(journal.fileno())
+        self.journal_size += len(data)
+        self.journal_records += len(changes)
+
+    def _compact(self, data: dict) -> None:
+        logger.debug("Compacting index journal")
+        self.generation += 1
+        write_atomic(self.filename, json.dumps({**data, "generation": self.generation}))
+        with open(self.journal_filename, "wb"):
+            pass
+        self.journal_records = 0
+        self.journal_size = 0
+
+
+def get_index(filename: str, index_format: str = DEFAULT_INDEX_FORMAT):
+    """Return index backend for format"""
+    if index_format == "json":
+        return JsonIndex(filename)
+    elif index_format == "journal":
+        return JournalIndex(filename)
+    elif index_format == "msgpack":
+        if msgpack is None:
+            raise QueueIndexError("The msgpack index format requires msgpack")
+        return MsgpackIndex(filename)
+    raise QueueIndexError(f"Unknown index format: {index_format}")
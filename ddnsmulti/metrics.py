@@ -0,0 +1,356 @@
+import asyncio
+import bisect
+import logging
+import math
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+)
+
+DEFAULT_LISTEN = "127.0.0.1"
+
+
+def format_value(value: float) -> str:
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def format_labels(labels: Iterable[Tuple[str, str]]) -> str:
+    res = []
+    for name, value in labels:
+        value = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        res.append(f'{name}="{value}"')
+    return "{" + ",".join(res) + "}" if res else ""
+
+
+class Registry:
+    """Collection of metrics, rendered in the Prometheus text format"""
+
+    def __init__(self) -> None:
+        self.metrics: List["Metric"] = []
+
+    def register(self, metric: "Metric") -> None:
+        self.metrics.append(metric)
+
+    def clear(self) -> None:
+        """Remove the values of all metrics"""
+        for metric in self.metrics:
+            metric.clear()
+
+    def snapshot(self) -> Dict[str, dict]:
+        """Return values of all metrics, for merging into another registry"""
+        return {metric.name: dict(metric._values) for metric in self.metrics}
+
+    def merge(self, snapshot: Dict[str, dict]) -> None:
+        """Add values from a snapshot of a registry with the same metrics
+
+        Counters and histograms are added, gauges take the value of the
+        snapshot.
+        """
+        for metric in self.metrics:
+            for values, value in snapshot.get(metric.name, {}).items():
+                metric.labels(*values).merge(value)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "".join([line + "\n" for line in lines])
+
+    def write_textfile(self, filename: str) -> None:
+        """Write metrics to file atomically (for the node exporter textfile collector)"""
+        directory = os.path.dirname(os.path.abspath(filename))
+        with tempfile.NamedTemporaryFile(
+            "wt", dir=directory, prefix=".metrics", delete=False
+        ) as output_file:
+            output_file.write(self.render())
+        os.chmod(output_file.name, 0o644)
+        os.replace(output_file.name, filename)
+
+
+REGISTRY = Registry()
+
+
+class CounterValue:
+    def __init__(self) -> None:
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def merge(self, other: "CounterValue") -> None:
+        self.value += other.value
+
+    def samples(self, name: str, labels: List[Tuple[str, str]]) -> List[str]:
+        return [f"{name}{format_labels(labels)} {format_value(self.value)}"]
+
+
+class GaugeValue(CounterValue):
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def merge(self, other: "GaugeValue") -> None:
+        self.value = other.value
+
+
+class HistogramValue:
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other: "HistogramValue") -> None:
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self, name: str, labels: List[Tuple[str, str]]) -> List[str]:
+        res = []
+        cumulative = 0
+        for bound, count in zip(list(self.buckets) + [math.inf], self.counts):
+            cumulative += count
+            bucket_labels = format_labels(labels + [("le", format_value(bound))])
+            res.append(f"{name}_bucket{bucket_labels} {cumulative}")
+        res.append(f"{name}_sum{format_labels(labels)} {format_value(self.sum)}")
+        res.append(f"{name}_count{format_labels(labels)} {self.count}")
+        return res
+
+
+class Metric:
+    """Metric family, with one value per combination of label values"""
+
+    type = "untyped"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        registry: Optional[Registry] = REGISTRY,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], object] = {}
+        if registry is not None:
+            registry.register(self)
+
+    def _new_value(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        """Return value for label values, creating it if needed"""
+        if (value := self._values.get(values)) is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"Wrong number of labels for {self.name}")
+            value = self._values[values] = self._new_value()
+        return value
+
+    def clear(self) -> None:
+        self._values = {}
+
+    def render(self) -> List[str]:
+        res = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for values, value in self._values.items():
+            res.extend(value.samples(self.name, list(zip(self.labelnames, values))))
+        return res
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def _new_value(self) -> CounterValue:
+        return CounterValue()
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def _new_value(self) -> GaugeValue:
+        return GaugeValue()
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(*args, **kwargs)
+
+    def _new_value(self) -> HistogramValue:
+        return HistogramValue(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+
+QUEUE_ENTRIES = Gauge("ddnsmulti_queue_entries", "Number of entries in queue")
+PENDING_ENTRIES = Gauge(
+    "ddnsmulti_pending_entries",
+    "Number of entries not yet accepted by nameserver",
+    ["nameserver"],
+)
+OLDEST_PENDING_AGE = Gauge(
+    "ddnsmulti_oldest_pending_age_seconds",
+    "Age of oldest entry not yet accepted by nameserver",
+    ["nameserver"],
+)
+UPDATE_DURATION = Histogram(
+    "ddnsmulti_update_duration_seconds",
+    "Time from sending an UPDATE to receiving the response",
+    ["nameserver"],
+)
+UPDATE_RESPONSES = Counter(
+    "ddnsmulti_update_responses_total",
+    "UPDATE responses received, by rcode",
+    ["nameserver", "rcode"],
+)
+UPDATE_ERRORS = Counter(
+    "ddnsmulti_update_errors_total",
+    "UPDATEs failed without a response (timeouts and connection errors)",
+    ["nameserver"],
+)
+PREFLIGHT_RESULTS = Counter(
+    "ddnsmulti_preflight_results_total",
+    "Entries evaluated against a zone snapshot, by result",
+    ["nameserver", "result"],
+)
+CONVERGENCE_DURATION = Histogram(
+    "ddnsmulti_convergence_seconds",
+    "Time from queueing an entry until all verifying nameservers serve it",
+    ["zone"],
+    buckets=(1, 5, 10, 30, 60, 300, 600, 1800, 3600, 7200, 21600, 86400),
+)
+INDEX_LOAD_DURATION = Histogram(
+    "ddnsmulti_index_load_duration_seconds", "Time spent loading the index"
+)
+INDEX_SAVE_DURATION = Histogram(
+    "ddnsmulti_index_save_duration_seconds", "Time spent saving the index"
+)
+INGEST_DURATION = Histogram(
+    "ddnsmulti_ingest_duration_seconds", "Time spent reading the queue directory"
+)
+
+
+def update_queue_metrics(queue, nameservers: Iterable[str]) -> None:
+    """Set queue gauges from current queue state"""
+    QUEUE_ENTRIES.set(len(queue.queue or []))
+    for address in nameservers:
+        count, age = queue.lag(address)
+        PENDING_ENTRIES.labels(address).set(count)
+        OLDEST_PENDING_AGE.labels(address).set(age or 0)
+
+
+class MetricsServer:
+    """Minimal HTTP server exposing metrics
+
+    `collect` is called before rendering metrics for every request, to
+    update metrics that are only computed on demand.
+    """
+
+    def __init__(
+        self,
+        host: str = DEFAULT_LISTEN,
+        port: int = 0,
+        registry: Registry = REGISTRY,
+        collect: Optional[Callable[[], None]] = None,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self.collect = collect
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info("Serving metrics on %s port %d", self.host, self.port)
+
+    async def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            request = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+            parts = request.decode(errors="replace").split()
+            if len(parts) < 2 or parts[0] != "GET":
+                status, body = "405 Method Not Allowed", b""
+            elif parts[1].split("?")[0] not in ["/", "/metrics"]:
+                status, body = "404 Not Found", b""
+            else:
+                if self.collect is not None:
+                    self.collect()
+                status, body = "200 OK", self.registry.render().encode()
+            writer.write(
+                (
+                    f"HTTP/1.0 {status}\r\n"
+                    f"Content-Type: {CONTENT_TYPE}\r\n"
+                    f"Content-Length: {len(body)}\r\n"
+                    "Connection: close\r\n\r\n"
+                ).encode()
+                + body
+            )
+            await writer.drain()
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,113 @@
+import logging
+from typing import Optional, Set
+
+import dns.asyncquery
+import dns.name
+import dns.rdata
+import dns.rdatatype
+import dns.tsig
+import dns.xfr
+import dns.zone
+
+from .change_request import ChangeRequest, RRsetIndex, RRsetKey
+
+logger = logging.getLogger(__name__)
+
+# Preflight results
+APPLIED = "applied"
+VIABLE = "viable"
+IMPOSSIBLE = "impossible"
+
+
+class ZoneSnapshot:
+    """Copy of a zone as served by a nameserver
+
+    The first refresh transfers the whole zone (AXFR), later refreshes
+    request the changes since the serial of the copy (IXFR).
+    """
+
+    def __init__(self, origin: dns.name.Name) -> None:
+        self.zone = dns.zone.Zone(origin, relativize=False)
+
+    @property
+    def origin(self) -> dns.name.Name:
+        return self.zone.origin
+
+    @property
+    def serial(self) -> Optional[int]:
+        soa = self.zone.get_rdataset(self.origin, dns.rdatatype.SOA)
+        return soa[0].serial if soa else None
+
+    async def refresh(
+        self,
+        address: str,
+        port: int = 53,
+        key: Optional[dns.tsig.Key] = None,
+        timeout: Optional[float] = None,
+    ) -> None:
+        """Bring copy up to date with nameserver"""
+        serial = self.serial
+        query, _ = dns.xfr.make_query(self.zone, keyring=key)
+        await dns.asyncquery.inbound_xfr(
+            address, self.zone, query, port=port, timeout=timeout
+        )
+        logger.debug(
+            "Transferred %s from %s (%s, serial %s)",
+            self.origin,
+            address,
+            "AXFR" if serial is None else "IXFR",
+            self.serial,
+        )
+
+    def rdatas(self, key: RRsetKey) -> Set[dns.rdata.Rdata]:
+        """Return rdata for owner name and rdatatype"""
+        name, rdtype = key
+        rdataset = self.zone.get_rdataset(name, rdtype)
+        return set(rdataset) if rdataset else set()
+
+
+class ZoneView:
+    """Zone contents as projected by a sequence of change requests
+
+    Change requests are evaluated against the snapshot in queue order. The
+    changes of viable change requests are applied to the view, so a later
+    change request depending on an earlier one is evaluated against the
+    contents the earlier one will leave behind.
+    """
+
+    def __init__(self, snapshot: ZoneSnapshot) -> None:
+        self.snapshot = snapshot
+        self.changed: RRsetIndex = {}
+
+    def rdatas(self, key: RRsetKey) -> Set[dns.rdata.Rdata]:
+        if key in self.changed:
+            return self.changed[key]
+        return self.snapshot.rdatas(key)
+
+    def evaluate(self, cr: ChangeRequest) -> str:
+        """Evaluate change request prerequisites against view
+
+        Returns APPLIED if the zone already contains the result of the change
+        request, VIABLE if the prerequisites hold and IMPOSSIBLE otherwise.
+        Change requests touching names outside the zone are left to the
+        nameserver and reported as VIABLE.
+        """
+
+        keys = set(cr.from_index) | set(cr.to_index)
+        if not all([name.is_subdomain(self.snapshot.origin) for name, _ in keys]):
+            return VIABLE
+
+        if cr.is_applied(self.rdatas):
+            return APPLIED
+
+        if not all(
+            [self.rdatas(key) == rdatas for key, rdatas in cr.from_index.items()]
+        ):
+            return IMPOSSIBLE
+
+        for key in keys:
+            if key in cr.from_index:
+                self.changed[key] = set(cr.to_index.get(key, set()))
+            else:
+                self.changed[key] = self.rdatas(key) | cr.to_index[key]
+        return VIABLE
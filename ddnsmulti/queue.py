@@ -3,83 +3,386 @@ import json
 import logging
 import os
 import time
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass, field
+from functools import cached_property
 from pathlib import Path, PosixPath
-from typing import Dict, Optional, Union
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 
-from ddnsmulti.change_request import ChangeRequest, ChangeRequestError
+import dns.exception
+import voluptuous as vol
+import yaml
+
+from ddnsmulti.change_request import DEFAULT_PRIORITY, ChangeRequest
+from ddnsmulti.index import DEFAULT_INDEX_FORMAT, get_index
+from ddnsmulti.metrics import INDEX_LOAD_DURATION, INDEX_SAVE_DURATION, INGEST_DURATION
 
 logger = logging.getLogger(__name__)
 
+ARCHIVE_FILENAME = "archive.jsonl"
+
+DEFAULT_INGEST_WORKERS = 1
+INGEST_CHUNK_SIZE = 1000
+
+# Errors caused by invalid change requests
+ENTRY_ERRORS = (ValueError, vol.Invalid, yaml.YAMLError, dns.exception.DNSException)
+
+
+# File signature used to detect changed files: (size, mtime_ns, inode)
+FileStat = Tuple[int, int, int]
+
+# Bulk files hold many change requests, either as one JSON object per line or
+# as a stream of YAML documents. Each record becomes an entry named
+# `filename#number`.
+NDJSON_SUFFIX = ".ndjson"
+BULK_YAML_SUFFIX = ".bulk.yaml"
+BULK_SUFFIXES = (NDJSON_SUFFIX, BULK_YAML_SUFFIX)
+RECORD_SEPARATOR = "#"
+
+
+def file_stat(st: os.stat_result) -> FileStat:
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+def read_file(filename: Path) -> Tuple[bytes, str, FileStat]:
+    """Return file contents, fingerprint and signature"""
+    with open(filename, "rb") as input_file:
+        raw_contents = input_file.read()
+        stat = file_stat(os.fstat(input_file.fileno()))
+    return (raw_contents, hashlib.sha256(raw_contents).hexdigest(), stat)
+
+
+def is_bulk_file(filename: str) -> bool:
+    return filename.endswith(BULK_SUFFIXES)
+
+
+def is_queue_file(filename: str) -> bool:
+    return filename.endswith(".yaml") or is_bulk_file(filename)
+
+
+def source_filename(filename: str) -> str:
+    """Return name of file in queue directory holding entry"""
+    return filename.split(RECORD_SEPARATOR, 1)[0]
+
+
+def parse_payload(filename: str, payload: str) -> ChangeRequest:
+    """Parse change request read from file"""
+    if source_filename(filename).endswith(NDJSON_SUFFIX):
+        return ChangeRequest.from_json(payload)
+    return ChangeRequest.from_yaml(payload)
+
+
+def format_payload(filename: str, cr: ChangeRequest) -> str:
+    """Return change request in the format of the file holding it"""
+    if source_filename(filename).endswith(NDJSON_SUFFIX):
+        return json.dumps(cr.to_dict())
+    return cr.to_yaml()
+
+
+def read_records(filename: str, input_file: BinaryIO) -> Iterator[Tuple[int, bytes]]:
+    """Yield record number and contents for each record in bulk file
+
+    The file is read as a stream, holding only one record in memory. Empty
+    records are skipped but still numbered, so that record numbers stay the
+    same when a record is removed by blanking it.
+    """
+
+    if filename.endswith(NDJSON_SUFFIX):
+        for number, line in enumerate(input_file, start=1):
+            if line.strip():
+                yield (number, line)
+        return
+
+    # text before the first document separator is only a record if not blank
+    number = 0
+    lines: List[bytes] = []
+    for line in input_file:
+        if line.startswith(b"---") and not line[3:].strip():
+            contents = b"".join(lines)
+            if number > 0 or contents.strip():
+                number += 1
+                if contents.strip():
+                    yield (number, contents)
+            lines = []
+        else:
+            lines.append(line)
+    contents = b"".join(lines)
+    if contents.strip():
+        yield (number + 1, contents)
+
 
 @dataclass
 class ChangeRequestQueueEntry:
+    """Queue entry
+
+    The change request itself is parsed from `yaml_str` on first access of
+    `cr`, entries loaded from the index only carry the zone and name changed.
+    Entries loaded from a msgpack index carry the change request in wire
+    format instead (`cr_wire`), from which `cr` is rebuilt on first access
+    and `yaml_str` is regenerated in the format of the source file when
+    needed.
+    """
+
     filename: str
     fingerprint: str
-    cr: ChangeRequest
-    yaml_str: str
+    yaml_str: Optional[str]
+    zone: str
+    change: str
     created: float = field(default_factory=time.time)
     nameservers: Dict[str, float] = field(default_factory=dict)
+    stat: Optional[FileStat] = None
+    priority: int = DEFAULT_PRIORITY
+    retries: Dict[str, Tuple[int, float]] = field(default_factory=dict)
+    verified: Dict[str, float] = field(default_factory=dict)
+    cr_wire: Optional[dict] = field(default=None, repr=False, compare=False)
+    queue: Optional["ChangeRequestQueue"] = field(
+        default=None, init=False, repr=False, compare=False
+    )
 
     @classmethod
     def from_file(cls, filename: Union[str, PosixPath]):
-        if isinstance(filename, str):
-            filename = Path(filename)
-        with open(filename, "rb") as input_file:
-            raw_contents = input_file.read()
-            fingerprint = hashlib.sha256(raw_contents).hexdigest()
-            yaml_str = raw_contents.decode()
         try:
-            cr = ChangeRequest.from_yaml(yaml_str)
-        except ChangeRequestError as exc:
+            return cls.load(filename)
+        except ENTRY_ERRORS as exc:
             logger.error("Error parsing %s: %s", filename, str(exc))
             return None
-        return cls(
-            cr=cr,
+
+    @classmethod
+    def load(cls, filename: Union[str, PosixPath]):
+        """Read entry from file, raising an exception on errors"""
+        if isinstance(filename, str):
+            filename = Path(filename)
+        raw_contents, fingerprint, stat = read_file(filename)
+        return cls.from_contents(filename.parts[-1], raw_contents, fingerprint, stat)
+
+    @classmethod
+    def from_contents(
+        cls,
+        filename: str,
+        raw_contents: bytes,
+        fingerprint: str,
+        stat: Optional[FileStat] = None,
+    ):
+        yaml_str = raw_contents.decode()
+        cr = parse_payload(filename, yaml_str)
+        res = cls(
             yaml_str=yaml_str,
-            filename=filename.parts[-1],
+            zone=cr.zone.to_text(),
+            change=cr.change.to_text(),
+            filename=filename,
             fingerprint=fingerprint,
             nameservers={},
+            stat=stat,
+            priority=cr.priority,
         )
+        res.cr = cr
+        return res
 
     @classmethod
     def from_dict(cls, data: dict):
-        return cls(
+        if "zone" in data and "change" in data:
+            zone = data["zone"]
+            change = data["change"]
+            cr = None
+        else:
+            cr = parse_payload(data["filename"], data["payload"])
+            zone = cr.zone.to_text()
+            change = cr.change.to_text()
+        res = cls(
             filename=data["filename"],
             fingerprint=data["fingerprint"],
-            cr=ChangeRequest.from_yaml(data["payload"]),
-            yaml_str=data["payload"],
+            yaml_str=data.get("payload"),
+            zone=zone,
+            change=change,
             created=data["created"],
             nameservers=data["nameservers"],
+            stat=tuple(data["stat"]) if data.get("stat") else None,
+            priority=data.get("priority", DEFAULT_PRIORITY),
+            retries={
+                address: tuple(retry)
+                for address, retry in data.get("retries", {}).items()
+            },
+            verified=data.get("verified", {}),
+            cr_wire=data.get("cr"),
         )
+        if cr is not None:
+            res.cr = cr
+        return res
+
+    @cached_property
+    def cr(self) -> ChangeRequest:
+        if self.cr_wire is not None:
+            return ChangeRequest.from_wire(self.cr_wire)
+        logger.debug("Parsing %s", self.filename)
+        return parse_payload(self.filename, self.yaml_str)
 
-    def as_dict(self) -> dict:
+    def as_dict(self, wire: bool = False) -> dict:
+        """Return entry as dict, with the change request in wire format if `wire`"""
+        if wire:
+            if self.cr_wire is None:
+                self.cr_wire = self.cr.to_wire()
+            payload = {"cr": self.cr_wire}
+        else:
+            if self.yaml_str is None:
+                self.yaml_str = format_payload(self.filename, self.cr)
+            payload = {"payload": self.yaml_str}
         return {
             "filename": self.filename,
             "fingerprint": self.fingerprint,
-            "payload": self.yaml_str,
+            **payload,
+            "zone": self.zone,
+            "change": self.change,
             "created": self.created,
-            "nameservers": self.nameservers,
+            "nameservers": dict(self.nameservers),
+            "stat": self.stat,
+            "priority": self.priority,
+            "retries": dict(self.retries),
+            "verified": dict(self.verified),
         }
 
-    def is_complete(self) -> bool:
-        """Return Tue if all nameservers has a timestamp"""
-        return all([v is not None for v in self.nameservers.values()])
+    def is_complete(self, nameservers: Optional[Iterable[str]] = None) -> bool:
+        """Return True if all nameservers has a timestamp"""
+        if nameservers is None:
+            return all([v is not None for v in self.nameservers.values()])
+        return all([self.nameservers.get(n) is not None for n in nameservers])
 
-    def set_nameserver_incomplete(self, address: str):
+    def completed(self, nameservers: Optional[Iterable[str]] = None) -> Optional[float]:
+        """Return time of last nameserver accepting the entry
+
+        If `nameservers` is given, only those nameservers are considered, and
+        the entry is complete at creation if the list is empty.
+        """
+        if nameservers is None:
+            if not self.nameservers or not self.is_complete():
+                return None
+            return max(self.nameservers.values())
+        nameservers = list(nameservers)
+        if not self.is_complete(nameservers):
+            return None
+        return max(
+            [self.nameservers[address] for address in nameservers],
+            default=self.created,
+        )
+
+    def is_pending(self, address: str) -> bool:
+        """Return True if the entry has not yet been accepted by nameserver"""
+        return self.nameservers.get(address) is None
+
+    def attempts(self, address: str) -> int:
+        """Return number of failed attempts to send entry to nameserver"""
+        return self.retries[address][0] if address in self.retries else 0
+
+    def is_due(self, address: str, now: Optional[float] = None) -> bool:
+        """Return True if a failed entry may be retried"""
+        if address not in self.retries:
+            return True
+        return self.retries[address][1] <= (time.time() if now is None else now)
+
+    def set_nameserver_incomplete(
+        self, address: str, retry_after: Optional[float] = None
+    ):
+        """Mark entry as not accepted by nameserver
+
+        If `retry_after` is given, the failed attempt is counted and the entry
+        is not retried for `retry_after` seconds.
+        """
         self.nameservers[address] = None
+        self.verified.pop(address, None)
+        if retry_after is not None:
+            self.retries[address] = (
+                self.attempts(address) + 1,
+                time.time() + retry_after,
+            )
+        if self.queue is not None:
+            self.queue.nameserver_changed(self, address)
 
     def set_nameserver_complete(self, address: str):
         self.nameservers[address] = time.time()
+        self.retries.pop(address, None)
+        self.verified.pop(address, None)
+        if self.queue is not None:
+            self.queue.nameserver_changed(self, address)
+
+    def set_nameserver_status(
+        self,
+        address: str,
+        value: Optional[float],
+        retry: Optional[Tuple[int, float]] = None,
+    ):
+        """Record nameserver status reported by a send worker"""
+        self.nameservers[address] = value
+        if retry:
+            self.retries[address] = tuple(retry)
+        else:
+            self.retries.pop(address, None)
+        self.verified.pop(address, None)
+        if self.queue is not None:
+            self.queue.nameserver_changed(self, address)
+
+    def is_verified(self, address: str) -> bool:
+        """Return True if nameserver was seen serving the change"""
+        return address in self.verified
+
+    def converged(self, nameservers: Iterable[str]) -> Optional[float]:
+        """Return time of last verification, if verified by all nameservers"""
+        if not all([self.is_verified(address) for address in nameservers]):
+            return None
+        return max([self.verified[address] for address in nameservers], default=None)
+
+    def set_nameserver_verified(self, address: str, value: Optional[float] = None):
+        self.verified[address] = time.time() if value is None else value
+        if self.queue is not None:
+            self.queue.nameserver_verified(self, address)
+
+
+def read_entry(
+    filename: Path, fingerprint: Optional[str] = None
+) -> Tuple[Optional[ChangeRequestQueueEntry], Optional[str], Optional[FileStat]]:
+    """Read entry from file (used by worker processes)
+
+    Returns a tuple of entry, error and file signature. If the file content
+    matches `fingerprint`, no entry is returned.
+    """
+    try:
+        raw_contents, new_fingerprint, stat = read_file(filename)
+        if new_fingerprint == fingerprint:
+            return (None, None, stat)
+        return (
+            ChangeRequestQueueEntry.from_contents(
+                filename.parts[-1], raw_contents, new_fingerprint, stat
+            ),
+            None,
+            stat,
+        )
+    except ENTRY_ERRORS + (OSError,) as exc:
+        return (None, str(exc), None)
 
 
 class ChangeRequestQueue:
-    def __init__(self, queue_directory: str, index: Optional[str] = None) -> None:
+    def __init__(
+        self,
+        queue_directory: str,
+        index: Optional[str] = None,
+        index_format: str = DEFAULT_INDEX_FORMAT,
+        nameservers: Iterable[str] = (),
+        workers: int = DEFAULT_INGEST_WORKERS,
+    ) -> None:
         self.queue_directory = Path(queue_directory)
+        self.workers = workers
         self.index_filename = index
+        self.index = get_index(index, index_format) if index else None
+        self.nameservers = list(nameservers)
         self.queue = None
-        self.files = set()
-        self._current_index = None
+        self.files: Dict[str, ChangeRequestQueueEntry] = {}
+        self.sources: Dict[str, FileStat] = {}
+        self.changes = []
+        self.breakers: Dict[str, float] = {}
+        self._sequence: Dict[str, int] = {}
+        self._next_sequence = 0
+        self._backlog: Dict[str, Dict[str, ChangeRequestQueueEntry]] = {
+            address: {} for address in self.nameservers
+        }
+        self._unordered: Set[str] = set()
 
     def __iter__(self):
         return self.queue.__iter__()
@@ -88,53 +391,435 @@ class ChangeRequestQueue:
         return self.queue[key]
 
     def __setitem__(self, key, value):
+        sequence = self._sequence.get(self.queue[key].filename)
+        self._untrack(self.queue[key])
+        self.files.pop(self.queue[key].filename, None)
         self.queue[key] = value
+        self._track(value, sequence)
+        self.files[value.filename] = value
+        self.changes.append({"op": "add", "entry": value.as_dict()})
 
     def __len__(self) -> int:
         return len(self.queue)
 
-    def load_index(self):
-        try:
-            with open(self.index_filename) as idx:
-                index_dict = json.load(idx)
-                self.queue = [
-                    ChangeRequestQueueEntry.from_dict(v) for v in index_dict["queue"]
-                ]
-                self.files = set([qe.filename for qe in self.queue])
-        except FileNotFoundError:
+    def add(self, qe: ChangeRequestQueueEntry) -> None:
+        """Add entry to queue"""
+        if self.queue is None:
             self.queue = []
-            self.files = set()
+        self.queue.append(qe)
+        self._track(qe)
+        self.files[qe.filename] = qe
+        self.changes.append({"op": "add", "entry": qe.as_dict()})
+
+    def _track(
+        self, qe: ChangeRequestQueueEntry, sequence: Optional[int] = None
+    ) -> None:
+        """Start tracking pending nameservers for entry"""
+        qe.queue = self
+        if sequence is None:
+            sequence = self._next_sequence
+            self._next_sequence += 1
+        self._sequence[qe.filename] = sequence
+        if qe.stat is not None:
+            # records removed from a bulk file keep the signature of the old
+            # file, so keep the most recent signature for the file
+            source = source_filename(qe.filename)
+            if (current := self.sources.get(source)) is None or current[1] <= qe.stat[
+                1
+            ]:
+                self.sources[source] = qe.stat
+        for address, backlog in self._backlog.items():
+            if qe.is_pending(address):
+                if backlog and self._order(qe) < self._order(
+                    next(reversed(backlog.values()))
+                ):
+                    self._unordered.add(address)
+                backlog[qe.filename] = qe
+
+    def _order(self, qe: ChangeRequestQueueEntry) -> Tuple[int, float, int]:
+        """Return sort key for entry, ordering by priority and creation time"""
+        return (qe.priority, qe.created, self._sequence[qe.filename])
+
+    def _untrack(self, qe: ChangeRequestQueueEntry) -> None:
+        """Stop tracking pending nameservers for entry"""
+        qe.queue = None
+        self._sequence.pop(qe.filename, None)
+        for backlog in self._backlog.values():
+            backlog.pop(qe.filename, None)
+
+    def nameserver_changed(self, qe: ChangeRequestQueueEntry, address: str) -> None:
+        """Record nameserver status change for entry"""
+        if (backlog := self._backlog.get(address)) is not None:
+            if not qe.is_pending(address):
+                backlog.pop(qe.filename, None)
+            elif qe.filename not in backlog:
+                backlog[qe.filename] = qe
+                self._unordered.add(address)
+        self.changes.append(
+            {
+                "op": "status",
+                "filename": qe.filename,
+                "nameserver": address,
+                "value": qe.nameservers[address],
+                "retry": qe.retries.get(address),
+            }
+        )
+
+    def nameserver_verified(self, qe: ChangeRequestQueueEntry, address: str) -> None:
+        """Record nameserver verification of entry"""
+        self.changes.append(
+            {
+                "op": "verified",
+                "filename": qe.filename,
+                "nameserver": address,
+                "value": qe.verified[address],
+            }
+        )
+
+    def set_breaker(self, address: str, open_until: Optional[float]) -> None:
+        """Record time until which circuit breaker of nameserver is open"""
+        if open_until is None:
+            self.breakers.pop(address, None)
+        else:
+            self.breakers[address] = open_until
+        self.changes.append(
+            {"op": "breaker", "nameserver": address, "value": open_until}
+        )
+
+    def pending(
+        self, nameservers: Optional[Iterable[str]] = None
+    ) -> List[ChangeRequestQueueEntry]:
+        """Return entries not yet accepted by all nameservers, in priority order"""
+        nameservers = self.nameservers if nameservers is None else list(nameservers)
+        if all([address in self._backlog for address in nameservers]):
+            entries = {}
+            for address in nameservers:
+                entries.update(self._backlog[address])
+            return sorted(entries.values(), key=self._order)
+        return sorted(
+            [qe for qe in self.queue or [] if not qe.is_complete(nameservers)],
+            key=self._order,
+        )
+
+    def pending_for(self, address: str) -> List[ChangeRequestQueueEntry]:
+        """Return entries not yet accepted by nameserver, in priority order"""
+        if address not in self._backlog:
+            return sorted(
+                [qe for qe in self.queue or [] if qe.is_pending(address)],
+                key=self._order,
+            )
+        if address in self._unordered:
+            self._backlog[address] = dict(
+                sorted(
+                    self._backlog[address].items(),
+                    key=lambda item: self._order(item[1]),
+                )
+            )
+            self._unordered.discard(address)
+        return list(self._backlog[address].values())
+
+    def unverified(self, nameservers: Iterable[str]) -> List[ChangeRequestQueueEntry]:
+        """Return entries accepted but not yet verified by any of nameservers"""
+        nameservers = list(nameservers)
+        return sorted(
+            [
+                qe
+                for qe in self.queue or []
+                if any(
+                    [
+                        not qe.is_pending(address) and not qe.is_verified(address)
+                        for address in nameservers
+                    ]
+                )
+            ],
+            key=self._order,
+        )
+
+    def lag(self, address: str) -> Tuple[int, Optional[float]]:
+        """Return number of pending entries and age of oldest pending entry"""
+        entries = self.pending_for(address)
+        if not entries:
+            return (0, None)
+        return (len(entries), time.time() - min([qe.created for qe in entries]))
+
+    def prune(
+        self,
+        nameservers: Iterable[str],
+        archive_directory: str,
+        max_age: Optional[float] = None,
+        max_entries: Optional[int] = None,
+        verify: Iterable[str] = (),
+    ) -> int:
+        """Move completed entries from queue to archive
+
+        Entries completed more than `max_age` seconds ago, and the oldest
+        entries exceeding `max_entries` completed entries, are archived. If
+        neither limit is given, all completed entries are archived. Entries
+        are only complete once verified by the nameservers in `verify`.
+        Archived entries are appended to an archive file, and their queue
+        files are moved to the archive directory.
+        """
+
+        if self.queue is None:
+            return 0
+
+        nameservers = list(nameservers)
+        verify = list(verify)
+        completed = sorted(
+            [
+                qe
+                for qe in self.queue
+                if qe.is_complete(nameservers)
+                and all([qe.is_verified(address) for address in verify])
+            ],
+            key=lambda qe: qe.completed(nameservers),
+        )
+        excess = len(completed) - max_entries if max_entries is not None else 0
+        now = time.time()
+        archived = [
+            qe
+            for position, qe in enumerate(completed)
+            if (max_age is None and max_entries is None)
+            or (max_age is not None and now - qe.completed(nameservers) >= max_age)
+            or position < excess
+        ]
+
+        # bulk files are archived when all their records can be archived
+        filenames = set([qe.filename for qe in archived])
+        held = set(
+            [
+                source_filename(qe.filename)
+                for qe in self.queue
+                if qe.filename not in filenames
+            ]
+        )
+        archived = [qe for qe in archived if source_filename(qe.filename) not in held]
+        if not archived:
+            return 0
+
+        archive_directory = Path(archive_directory)
+        with open(archive_directory / ARCHIVE_FILENAME, "at") as archive:
+            archive.write("".join([json.dumps(qe.as_dict()) + "\n" for qe in archived]))
+
+        filenames = set([qe.filename for qe in archived])
+        self.queue = [qe for qe in self.queue if qe.filename not in filenames]
+        for filename in filenames:
+            self.files.pop(filename, None)
+        for qe in archived:
+            self._untrack(qe)
+            self.changes.append({"op": "remove", "filename": qe.filename})
+            logger.debug("Archived %s", qe.filename)
+
+        for source in set([source_filename(filename) for filename in filenames]):
+            try:
+                os.replace(self.queue_directory / source, archive_directory / source)
+            except FileNotFoundError:
+                pass
+            self.sources.pop(source, None)
+
+        return len(archived)
+
+    def load_index(self):
+        if self.index is None:
+            raise ValueError("No index defined")
+        with INDEX_LOAD_DURATION.time():
+            self.queue = [
+                ChangeRequestQueueEntry.from_dict(v) for v in self.index.load()
+            ]
+        self.breakers = dict(self.index.breakers)
+        self._sequence = {}
+        self._next_sequence = 0
+        self.sources = {}
+        self._backlog = {address: {} for address in self.nameservers}
+        self._unordered = set()
+        for qe in self.queue:
+            self._track(qe)
+        self.files = {qe.filename: qe for qe in self.queue}
+        self.changes = []
 
     def save_index(self):
         if self.queue is None:
             raise ValueError("No queue")
-        if self.index_filename is None:
+        if self.index is None:
             raise ValueError("No index defined")
-        with open(self.index_filename, "wt") as idx:
-            json.dump(self.as_dict(), idx, indent=4)
+        with INDEX_SAVE_DURATION.time():
+            merged = self.index.save(self, self.changes)
+        self.changes = []
+        if merged:
+            logger.debug("Reloading index merged with changes from other processes")
+            self.load_index()
 
     def get_files(self):
-        return [
-            f
-            for f in os.listdir(self.queue_directory)
-            if os.path.isfile(os.path.join(self.queue_directory, f))
-            and f.endswith(".yaml")
-        ]
+        return list(self.scan_files().keys())
 
-    def as_dict(self) -> dict:
-        return {"queue": [qe.as_dict() for qe in self.queue or []]}
+    def scan_files(self) -> Dict[str, FileStat]:
+        """Return signatures of all update files in queue directory"""
+        with os.scandir(self.queue_directory) as it:
+            return {
+                entry.name: file_stat(entry.stat())
+                for entry in it
+                if is_queue_file(entry.name) and entry.is_file()
+            }
+
+    def as_dict(self, wire: bool = False) -> dict:
+        return {
+            "queue": [qe.as_dict(wire) for qe in self.queue or []],
+            "breakers": dict(self.breakers),
+        }
 
     def update_queue(self):
+        with INGEST_DURATION.time():
+            self._update_queue()
+
+    def _update_queue(self):
         if self.queue is None:
             self.queue = []
-        for f in self.get_files():
-            if f not in self.files:
-                if self.index_filename:
-                    logger.debug("Adding %s to index", f)
-                else:
-                    logger.debug("Reading %s", f)
-                self.queue.append(
-                    ChangeRequestQueueEntry.from_file(self.queue_directory / f)
-                )
-            else:
+        changed_files = []
+        bulk_files = []
+        for f, stat in self.scan_files().items():
+            if self.sources.get(f) == stat:
                 logger.debug("Skip %s, already in index", f)
+            elif is_bulk_file(f):
+                bulk_files.append(f)
+            else:
+                changed_files.append(f)
+        if self.workers > 1 and len(changed_files) > 1:
+            self.update_queue_parallel(changed_files)
+        else:
+            for f in changed_files:
+                self.add_file(f, check_stat=False)
+        for f in bulk_files:
+            self.add_bulk_file(f, check_stat=False)
+
+    def update_queue_parallel(
+        self, filenames: List[str], chunk_size: int = INGEST_CHUNK_SIZE
+    ):
+        """Read files using a pool of worker processes
+
+        Files are read in chunks to bound memory use, entries are added to
+        the queue in directory order.
+        """
+
+        logger.debug("Reading %d files using %d workers", len(filenames), self.workers)
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            for start in range(0, len(filenames), chunk_size):
+                end = start + chunk_size
+                chunk = filenames[start:end]
+                results = executor.map(
+                    read_entry,
+                    [self.queue_directory / f for f in chunk],
+                    [
+                        self.files[f].fingerprint if f in self.files else None
+                        for f in chunk
+                    ],
+                    chunksize=max(1, len(chunk) // (self.workers * 4)),
+                )
+                for f, (qe, error, stat) in zip(chunk, results):
+                    if error is not None:
+                        logger.error("Error parsing %s: %s", f, error)
+                    elif qe is None:
+                        self.set_stat(self.files[f], stat)
+                    else:
+                        self.add_or_replace(qe)
+
+    def add_file(
+        self, filename: str, check_stat: bool = True
+    ) -> Optional[ChangeRequestQueueEntry]:
+        """Add file in queue directory to queue, or refresh it if changed
+
+        Files already in the queue are only read if their signature (size,
+        modification time and inode) has changed, and only parsed if their
+        content has changed. Returns the new entry, if any.
+        """
+        if self.queue is None:
+            self.queue = []
+        path = self.queue_directory / filename
+        existing = self.files.get(filename)
+        try:
+            if check_stat and existing is not None:
+                if existing.stat == file_stat(os.stat(path)):
+                    logger.debug("Skip %s, already in index", filename)
+                    return None
+            raw_contents, fingerprint, stat = read_file(path)
+        except OSError as exc:
+            logger.error("Error reading %s: %s", filename, str(exc))
+            return None
+        return self.add_contents(filename, raw_contents, fingerprint, stat)
+
+    def add_bulk_file(
+        self, filename: str, check_stat: bool = True
+    ) -> List[ChangeRequestQueueEntry]:
+        """Add records in bulk file in queue directory to queue
+
+        The file is only read if its signature has changed. Records are read
+        one at a time and only parsed if their content has changed. Returns
+        the new entries.
+        """
+        if self.queue is None:
+            self.queue = []
+        entries = []
+        try:
+            with open(self.queue_directory / filename, "rb") as input_file:
+                stat = file_stat(os.fstat(input_file.fileno()))
+                if check_stat and self.sources.get(filename) == stat:
+                    logger.debug("Skip %s, already in index", filename)
+                    return entries
+                logger.debug("Reading bulk file %s", filename)
+                for number, raw_contents in read_records(filename, input_file):
+                    qe = self.add_contents(
+                        f"{filename}{RECORD_SEPARATOR}{number}",
+                        raw_contents,
+                        hashlib.sha256(raw_contents).hexdigest(),
+                        stat,
+                    )
+                    if qe is not None:
+                        entries.append(qe)
+                self.sources[filename] = stat
+        except OSError as exc:
+            logger.error("Error reading %s: %s", filename, str(exc))
+        return entries
+
+    def ingest_file(self, filename: str) -> List[ChangeRequestQueueEntry]:
+        """Add single or bulk file in queue directory, return new entries"""
+        if is_bulk_file(filename):
+            return self.add_bulk_file(filename)
+        if is_queue_file(filename) and (qe := self.add_file(filename)):
+            return [qe]
+        return []
+
+    def add_contents(
+        self, filename: str, raw_contents: bytes, fingerprint: str, stat: FileStat
+    ) -> Optional[ChangeRequestQueueEntry]:
+        """Add entry read from file, unless its content is unchanged"""
+        existing = self.files.get(filename)
+        if existing is not None and existing.fingerprint == fingerprint:
+            logger.debug("Skip %s, content unchanged", filename)
+            self.set_stat(existing, stat)
+            return None
+        if self.index_filename:
+            logger.debug("Adding %s to index", filename)
+        else:
+            logger.debug("Reading %s", filename)
+        try:
+            qe = ChangeRequestQueueEntry.from_contents(
+                filename, raw_contents, fingerprint, stat
+            )
+        except ENTRY_ERRORS as exc:
+            logger.error("Error parsing %s: %s", filename, str(exc))
+            return None
+        self.add_or_replace(qe)
+        return qe
+
+    def add_or_replace(self, qe: ChangeRequestQueueEntry) -> None:
+        """Add entry to queue, replacing any entry read from the same file"""
+        if (existing := self.files.get(qe.filename)) is None:
+            self.add(qe)
+            return
+        logger.info("Replacing %s, file has changed", qe.filename)
+        self[self.queue.index(existing)] = qe
+
+    def set_stat(self, qe: ChangeRequestQueueEntry, stat: FileStat) -> None:
+        """Update file signature of entry"""
+        qe.stat = stat
+        self.sources[source_filename(qe.filename)] = stat
+        self.changes.append({"op": "stat", "filename": qe.filename, "stat": stat})
@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INITIAL_DELAY = 30
+DEFAULT_MAX_DELAY = 3600
+DEFAULT_BREAKER_THRESHOLD = 5
+
+# Largest exponent used when computing backoff delays
+MAX_BACKOFF_EXPONENT = 32
+
+
+def backoff_delay(
+    attempts: int,
+    initial: float = DEFAULT_INITIAL_DELAY,
+    maximum: float = DEFAULT_MAX_DELAY,
+) -> float:
+    """Return delay before retrying after a number of failed attempts
+
+    The delay doubles for every failed attempt, up to `maximum`. A random
+    delay between half and all of that is returned, spreading out retries of
+    entries that failed at the same time.
+    """
+    exponent = min(max(attempts - 1, 0), MAX_BACKOFF_EXPONENT)
+    delay = min(initial * 2**exponent, maximum)
+    return random.uniform(delay / 2, delay)
+
+
+class CircuitBreaker:
+    """Circuit breaker for a single nameserver
+
+    After `threshold` consecutive failures (timeouts or connection errors)
+    the breaker opens and no further updates are sent to the nameserver for
+    `delay` seconds. At the start of the first send cycle after that, a
+    single probe is let through while other updates wait for its result. If
+    the probe succeeds the breaker closes, otherwise it opens again.
+
+    A breaker created with `open_until` starts open. `on_change` is called
+    with the address and the time until which the breaker is open whenever
+    it opens, and with None when it closes again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(
+        self,
+        address: str,
+        threshold: int = DEFAULT_BREAKER_THRESHOLD,
+        delay: float = DEFAULT_INITIAL_DELAY,
+        open_until: Optional[float] = None,
+        on_change: Optional[Callable[[str, Optional[float]], None]] = None,
+    ):
+        self.address = address
+        self.threshold = threshold
+        self.delay = delay
+        self.failures = 0
+        self.open_until = open_until
+        self.state = self.CLOSED if open_until is None else self.OPEN
+        self.on_change = on_change
+        self._probe: Optional[asyncio.Future] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == self.OPEN
+
+    def new_cycle(self) -> None:
+        """Start a new send cycle, allowing a probe if the delay has passed"""
+        if self.state == self.CLOSED:
+            return
+        if self.open_until is not None and time.time() < self.open_until:
+            self.state = self.OPEN
+        else:
+            self.state = self.HALF_OPEN
+        self._probe = None
+
+    async def allow(self) -> bool:
+        """Return True if an update may be sent to the nameserver"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return False
+        if self._probe is None:
+            logger.info("Probing %s", self.address)
+            self._probe = asyncio.get_running_loop().create_future()
+            return True
+        await asyncio.shield(self._probe)
+        return self.state == self.CLOSED
+
+    def success(self) -> None:
+        if self.state != self.CLOSED:
+            logger.info("%s is available again", self.address)
+            self.open_until = None
+            if self.on_change is not None:
+                self.on_change(self.address, None)
+        self.failures = 0
+        self.state = self.CLOSED
+        self._resolve_probe()
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.state == self.HALF_OPEN or (
+            self.state == self.CLOSED and self.failures >= self.threshold
+        ):
+            logger.warning(
+                "%s unavailable after %d consecutive failures, suspending updates",
+                self.address,
+                self.failures,
+            )
+            self.state = self.OPEN
+            self.open_until = time.time() + self.delay
+            if self.on_change is not None:
+                self.on_change(self.address, self.open_until)
+        self._resolve_probe()
+
+    def _resolve_probe(self) -> None:
+        if self._probe is not None and not self._probe.done():
+            self._probe.set_result(None)
@@ -0,0 +1,696 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import dns.flags
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdatatype
+import dns.update
+
+from .change_request import RRsetKey
+from .config import UpdaterConfig
+from .connection import ConnectionPool
+from .metrics import (
+    CONVERGENCE_DURATION,
+    PREFLIGHT_RESULTS,
+    UPDATE_DURATION,
+    UPDATE_ERRORS,
+    UPDATE_RESPONSES,
+)
+from .preflight import APPLIED, IMPOSSIBLE, ZoneSnapshot, ZoneView
+from .queue import ChangeRequestQueue, ChangeRequestQueueEntry
+from .retry import CircuitBreaker, backoff_delay
+from .wire import MessageCache
+
+# Unsigned messages shared by all senders in this process
+MESSAGE_CACHE = MessageCache()
+
+logger = logging.getLogger(__name__)
+
+# Maximum size of a DNS message over TCP, minus room for header, zone and TSIG
+MAX_MESSAGE_SIZE = 65535
+MESSAGE_SIZE_RESERVE = 1024
+
+PREREQUISITE_RCODES = {
+    dns.rcode.YXDOMAIN,
+    dns.rcode.YXRRSET,
+    dns.rcode.NXDOMAIN,
+    dns.rcode.NXRRSET,
+}
+
+
+def make_batches(
+    entries: List[ChangeRequestQueueEntry],
+    max_entries: int,
+    messages: MessageCache,
+    max_size: int = MAX_MESSAGE_SIZE - MESSAGE_SIZE_RESERVE,
+) -> List[List[ChangeRequestQueueEntry]]:
+    """Split entries for a single zone into batches, preserving order
+
+    A batch never contains more than one change request touching the same
+    name, as prerequisites are evaluated before any update in the message.
+    """
+
+    res = []
+    batch = []
+    batch_names = set()
+    batch_size = 0
+
+    for qe in entries:
+        names = qe.cr.names()
+        size = len(messages.get(qe))
+        if batch and (
+            len(batch) >= max_entries
+            or batch_size + size > max_size
+            or not batch_names.isdisjoint(names)
+        ):
+            res.append(batch)
+            batch = []
+            batch_names = set()
+            batch_size = 0
+        batch.append(qe)
+        batch_names.update(names)
+        batch_size += size
+
+    if batch:
+        res.append(batch)
+
+    return res
+
+
+def due_entries(
+    entries: List[ChangeRequestQueueEntry], address: str, now: float
+) -> List[ChangeRequestQueueEntry]:
+    """Return entries pending for nameserver and due for sending
+
+    An entry not yet due for a retry holds back all later entries changing
+    the same name, as they may depend on it.
+    """
+
+    res = []
+    held = set()
+    for qe in sorted(entries, key=lambda qe: qe.created):
+        if not qe.is_pending(address) or qe.cr.change in held:
+            continue
+        if qe.is_due(address, now):
+            res.append(qe)
+        else:
+            held.add(qe.cr.change)
+    return res
+
+
+def schedule(entries: List[ChangeRequestQueueEntry]) -> List[ChangeRequestQueueEntry]:
+    """Order entries for sending
+
+    Entries are sent by priority. Entries of the same priority are taken
+    from each zone in turn, so a large change to one zone does not hold back
+    the others. An entry inherits the priority of any later entry changing
+    the same name, as the later change request depends on it.
+    """
+
+    ordered = sorted(entries, key=lambda qe: qe.created)
+
+    priorities: Dict[int, int] = {}
+    best: Dict[dns.name.Name, int] = {}
+    for qe in reversed(ordered):
+        best[qe.cr.change] = min(qe.priority, best.get(qe.cr.change, qe.priority))
+        priorities[id(qe)] = best[qe.cr.change]
+
+    keys = {}
+    turns: Dict[tuple, int] = defaultdict(int)
+    for qe in sorted(ordered, key=lambda qe: priorities[id(qe)]):
+        priority = priorities[id(qe)]
+        keys[id(qe)] = (priority, turns[(priority, qe.cr.zone)], qe.created)
+        turns[(priority, qe.cr.zone)] += 1
+
+    return sorted(ordered, key=lambda qe: keys[id(qe)])
+
+
+def observe_convergence(qe: ChangeRequestQueueEntry, addresses: Iterable[str]) -> None:
+    """Record time to convergence if entry is now verified by all addresses"""
+    if (converged := qe.converged(addresses)) is not None:
+        CONVERGENCE_DURATION.labels(qe.zone).observe(converged - qe.created)
+
+
+class UpdateSender:
+    """Asynchronous send engine
+
+    Each queue entry is sent to all nameservers concurrently, limited by a
+    global and a per-nameserver concurrency limit. Entries are started in
+    priority order, taking zones in turn (see `schedule`). Entries changing
+    the same name are always sent to a nameserver in the order they were
+    queued, as a later change request may depend on the result of an
+    earlier one.
+
+    Each entry is converted to an unsigned message in wire format once and
+    cached by fingerprint; sending it to a nameserver only sets a new message
+    ID and signs it.
+
+    Updates are pipelined over a pool of persistent TCP connections per
+    nameserver. Connections are kept open between calls to `send` until the
+    sender is closed.
+
+    With batching enabled, pending entries are grouped by zone and merged
+    into UPDATE messages of at most `batch_size` change requests. Batches for
+    a zone are sent in order. A batch failing on prerequisites is bisected
+    until the failing entries are found.
+
+    Entries that fail are retried with exponential backoff; entries not yet
+    due for a retry are skipped. Each nameserver has a circuit breaker that
+    stops sending to it after repeated timeouts or connection errors. If a
+    queue is given, breakers start from and record their state in the queue,
+    so that it is kept across runs.
+
+    For nameservers with preflight enabled, the zones of pending entries are
+    transferred first and the prerequisites of each entry are evaluated
+    locally. Entries already applied are marked as accepted and entries that
+    would fail their prerequisites are retried later, without sending either.
+    Zone copies are kept by the sender and refreshed by IXFR.
+
+    For nameservers with verification enabled, accepted entries are verified
+    after sending by querying the nameserver for the changed RRsets.
+    """
+
+    def __init__(
+        self,
+        config: UpdaterConfig,
+        debug: bool = False,
+        messages: Optional[MessageCache] = None,
+        queue: Optional[ChangeRequestQueue] = None,
+    ) -> None:
+        self.config = config
+        self.debug = debug
+        self.messages = messages if messages is not None else MESSAGE_CACHE
+        self.queue = queue
+        self.pools: Dict[str, ConnectionPool] = {}
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.snapshots: Dict[Tuple[str, dns.name.Name], ZoneSnapshot] = {}
+        self.messages_sent = 0
+
+    async def send(self, entries: Iterable[ChangeRequestQueueEntry]) -> None:
+        """Send all pending entries to all nameservers"""
+
+        entries = [qe for qe in entries if qe]
+        self._open_pools()
+
+        global_limit = asyncio.Semaphore(self.config.concurrency)
+        tasks = []
+        now = time.time()
+
+        scheduled = {}
+        for nameserver in self.config.nameservers:
+            address = str(nameserver["address"])
+            self._breaker(address).new_cycle()
+            scheduled[address] = schedule(due_entries(entries, address, now))
+
+        preflight = [
+            nameserver
+            for nameserver in self.config.nameservers
+            if nameserver["preflight"]
+            and scheduled[str(nameserver["address"])]
+            and not self._breaker(str(nameserver["address"])).is_open
+        ]
+        for nameserver, pending in zip(
+            preflight,
+            await asyncio.gather(
+                *[
+                    self.preflight(nameserver, scheduled[str(nameserver["address"])])
+                    for nameserver in preflight
+                ]
+            ),
+        ):
+            scheduled[str(nameserver["address"])] = pending
+
+        for nameserver in self.config.nameservers:
+            limit = asyncio.Semaphore(nameserver["concurrency"])
+            pending = scheduled[str(nameserver["address"])]
+
+            if self.config.batch_size > 1:
+                zones: Dict[dns.name.Name, List[ChangeRequestQueueEntry]]
+                zones = defaultdict(list)
+                for qe in pending:
+                    zones[qe.cr.zone].append(qe)
+                for zone_entries in zones.values():
+                    tasks.append(
+                        asyncio.create_task(
+                            self._send_batches(
+                                global_limit, limit, nameserver, zone_entries
+                            )
+                        )
+                    )
+            else:
+                chains: Dict[dns.name.Name, asyncio.Task] = {}
+                for qe in pending:
+                    task = asyncio.create_task(
+                        self._send_chained(
+                            chains.get(qe.cr.change),
+                            global_limit,
+                            limit,
+                            nameserver,
+                            qe,
+                        )
+                    )
+                    chains[qe.cr.change] = task
+                    tasks.append(task)
+
+        start = time.perf_counter()
+        messages_sent = self.messages_sent
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+        if messages_sent := self.messages_sent - messages_sent:
+            logger.info(
+                "Sent %d updates in %.3f seconds (%.1f updates/s)",
+                messages_sent,
+                elapsed,
+                messages_sent / elapsed,
+            )
+
+        await self.verify(entries)
+
+    async def verify(self, entries: Iterable[ChangeRequestQueueEntry]) -> None:
+        """Verify that nameservers serve the changes of accepted entries
+
+        Each changed RRset is queried once per nameserver, with all queries
+        in flight concurrently up to the nameserver concurrency limit.
+        Entries not served as expected are verified again on the next call.
+        """
+
+        entries = [qe for qe in entries if qe]
+        self._open_pools()
+        addresses = self.config.verify_addresses
+        lookups: Dict[tuple, asyncio.Task] = {}
+        tasks = []
+        for nameserver in self.config.nameservers:
+            address = str(nameserver["address"])
+            if address not in addresses or self._breaker(address).is_open:
+                continue
+            limit = asyncio.Semaphore(nameserver["concurrency"])
+            for qe in entries:
+                if qe.is_pending(address) or qe.is_verified(address):
+                    continue
+                for key in set(qe.cr.from_index) | set(qe.cr.to_index):
+                    if (address, key) not in lookups:
+                        lookups[(address, key)] = asyncio.create_task(
+                            self._lookup(limit, nameserver, key)
+                        )
+                tasks.append((address, qe))
+        if not tasks:
+            return
+
+        await asyncio.gather(*lookups.values())
+        for address, qe in tasks:
+            keys = set(qe.cr.from_index) | set(qe.cr.to_index)
+            if any([lookups[(address, key)].result() is None for key in keys]):
+                continue
+            if not qe.cr.is_applied(lambda key: lookups[(address, key)].result()):
+                logger.info(
+                    "%s (%s) not yet served by %s", qe.filename, qe.cr.change, address
+                )
+                continue
+            qe.set_nameserver_verified(address)
+            logger.info("%s (%s) verified at %s", qe.filename, qe.cr.change, address)
+            observe_convergence(qe, addresses)
+
+    async def _lookup(
+        self, limit: asyncio.Semaphore, nameserver: dict, key: RRsetKey
+    ) -> Optional[set]:
+        """Return rdata served by nameserver for RRset, or None on failure
+
+        Delegation NS RRsets and glue are served by the parent as referrals,
+        so all sections of the response are searched.
+        """
+
+        name, rdtype = key
+        query = dns.message.make_query(name, rdtype)
+        query.flags &= ~dns.flags.RD
+        context = self.config.contexts[str(nameserver["address"])]
+        address = context.address
+        try:
+            async with limit:
+                response = await self.pools[address].query(
+                    query.to_wire(), None, context.timeout
+                )
+        except Exception as exc:
+            logger.debug(
+                "Query for %s %s at %s failed: %s",
+                name,
+                dns.rdatatype.to_text(rdtype),
+                address,
+                str(exc) or exc.__class__.__name__,
+            )
+            return None
+        if response.rcode() not in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN):
+            return None
+        res = set()
+        for section in (response.answer, response.authority, response.additional):
+            for rrset in section:
+                if rrset.name == name and rrset.rdtype == rdtype:
+                    res.update(rrset)
+        return res
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        """Close all nameserver connections"""
+        await asyncio.gather(*[pool.close() for pool in self.pools.values()])
+        self.pools = {}
+
+    def _open_pools(self) -> None:
+        for nameserver in self.config.nameservers:
+            context = self.config.contexts[str(nameserver["address"])]
+            if context.address not in self.pools:
+                self.pools[context.address] = ConnectionPool(
+                    context.address,
+                    port=context.port,
+                    size=nameserver["connections"],
+                    transport=context.transport,
+                    udp_timeout=context.udp_timeout,
+                )
+
+    def _breaker(self, address: str) -> CircuitBreaker:
+        if address not in self.breakers:
+            self.breakers[address] = CircuitBreaker(
+                address,
+                threshold=self.config.retry["breaker_threshold"],
+                delay=self.config.retry["initial_delay"],
+                open_until=self.queue.breakers.get(address) if self.queue else None,
+                on_change=self.queue.set_breaker if self.queue else None,
+            )
+        return self.breakers[address]
+
+    def _retry_later(
+        self, address: str, entries: List[ChangeRequestQueueEntry]
+    ) -> None:
+        """Mark entries as failed, to be retried after a backoff delay"""
+        for qe in entries:
+            qe.set_nameserver_incomplete(
+                address,
+                retry_after=backoff_delay(
+                    qe.attempts(address) + 1,
+                    self.config.retry["initial_delay"],
+                    self.config.retry["max_delay"],
+                ),
+            )
+
+    async def _send_chained(
+        self,
+        previous: Optional[asyncio.Task],
+        global_limit: asyncio.Semaphore,
+        limit: asyncio.Semaphore,
+        nameserver: dict,
+        qe: ChangeRequestQueueEntry,
+    ) -> None:
+        if previous is not None:
+            await asyncio.wait([previous])
+        if not await self._breaker(str(nameserver["address"])).allow():
+            return
+        async with limit, global_limit:
+            await self.send_entry(nameserver, qe)
+
+    async def _send_batches(
+        self,
+        global_limit: asyncio.Semaphore,
+        limit: asyncio.Semaphore,
+        nameserver: dict,
+        entries: List[ChangeRequestQueueEntry],
+    ) -> None:
+        breaker = self._breaker(str(nameserver["address"]))
+        for batch in make_batches(entries, self.config.batch_size, self.messages):
+            if not await breaker.allow():
+                return
+            async with limit, global_limit:
+                await self.send_batch(nameserver, batch)
+
+    async def _snapshot(
+        self, nameserver: dict, zone: dns.name.Name
+    ) -> Optional[ZoneSnapshot]:
+        """Return up to date copy of zone at nameserver, or None on failure"""
+        context = self.config.contexts[str(nameserver["address"])]
+        address = context.address
+        snapshot = self.snapshots.pop((address, zone), None) or ZoneSnapshot(zone)
+        try:
+            await snapshot.refresh(
+                address, port=context.port, key=context.key, timeout=context.timeout
+            )
+        except Exception as exc:
+            logger.warning(
+                "Zone transfer of %s from %s failed: %s",
+                zone,
+                address,
+                str(exc) or exc.__class__.__name__,
+            )
+            return None
+        self.snapshots[(address, zone)] = snapshot
+        return snapshot
+
+    async def preflight(
+        self, nameserver: dict, entries: List[ChangeRequestQueueEntry]
+    ) -> List[ChangeRequestQueueEntry]:
+        """Evaluate entries against zone snapshots, returning entries to send
+
+        Entries of zones that could not be transferred are all returned.
+        """
+
+        address = str(nameserver["address"])
+        zones: Dict[dns.name.Name, List[ChangeRequestQueueEntry]]
+        zones = defaultdict(list)
+        for qe in sorted(entries, key=lambda qe: qe.created):
+            zones[qe.cr.zone].append(qe)
+        snapshots = await asyncio.gather(
+            *[self._snapshot(nameserver, zone) for zone in zones]
+        )
+
+        skipped = set()
+        for zone_entries, snapshot in zip(zones.values(), snapshots):
+            if snapshot is None:
+                continue
+            view = ZoneView(snapshot)
+            for qe in zone_entries:
+                result = view.evaluate(qe.cr)
+                PREFLIGHT_RESULTS.labels(address, result).inc()
+                if result == APPLIED:
+                    skipped.add(id(qe))
+                    qe.set_nameserver_complete(address)
+                    logger.info(
+                        "%s (%s) already applied at %s",
+                        qe.filename,
+                        qe.cr.change,
+                        address,
+                    )
+                elif result == IMPOSSIBLE:
+                    skipped.add(id(qe))
+                    self._retry_later(address, [qe])
+                    logger.warning(
+                        "%s (%s) fails prerequisites at %s, not sent",
+                        qe.filename,
+                        qe.cr.change,
+                        address,
+                    )
+
+        return [qe for qe in entries if id(qe) not in skipped]
+
+    async def _query(
+        self, nameserver: dict, wire: bytes
+    ) -> Tuple[dns.message.Message, bool]:
+        """Send UPDATE, returning response and whether it was resent"""
+        if self.debug:
+            print(str(dns.message.from_wire(wire)))
+
+        context = self.config.contexts[str(nameserver["address"])]
+        address = context.address
+        start = time.perf_counter()
+        try:
+            response, resent = await self.pools[address].update(
+                wire, context.key, context.timeout
+            )
+        except Exception:
+            UPDATE_ERRORS.labels(address).inc()
+            raise
+        UPDATE_DURATION.labels(address).observe(time.perf_counter() - start)
+        UPDATE_RESPONSES.labels(address, dns.rcode.to_text(response.rcode())).inc()
+        self.messages_sent += 1
+        return (response, resent)
+
+    async def _is_applied(
+        self, nameserver: dict, entries: List[ChangeRequestQueueEntry]
+    ) -> bool:
+        """Return True if nameserver serves the changes of all entries"""
+        limit = asyncio.Semaphore(nameserver["concurrency"])
+        keys = set()
+        for qe in entries:
+            keys.update(set(qe.cr.from_index) | set(qe.cr.to_index))
+        keys = list(keys)
+        results = await asyncio.gather(
+            *[self._lookup(limit, nameserver, key) for key in keys]
+        )
+        if any([rdatas is None for rdatas in results]):
+            return False
+        served = dict(zip(keys, results))
+        return all([qe.cr.is_applied(served.get) for qe in entries])
+
+    async def send_entry(self, nameserver: dict, qe: ChangeRequestQueueEntry) -> None:
+        """Send a single entry to a single nameserver and record the result"""
+
+        address = str(nameserver["address"])
+        breaker = self._breaker(address)
+        if breaker.is_open:
+            logger.debug(
+                "%s (%s) not sent to %s, nameserver unavailable",
+                qe.filename,
+                qe.cr.change,
+                address,
+            )
+            return
+        logger.info(
+            "%s (%s) scheduled for update via %s",
+            qe.filename,
+            qe.cr.change,
+            address,
+        )
+        try:
+            response, resent = await self._query(nameserver, self.messages.get(qe))
+        except Exception as exc:
+            breaker.failure()
+            self._retry_later(address, [qe])
+            logger.warning(
+                "%s (%s) not sent to %s: %s",
+                qe.filename,
+                qe.cr.change,
+                address,
+                str(exc) or exc.__class__.__name__,
+            )
+            return
+
+        breaker.success()
+        if (
+            resent
+            and response.rcode() in PREREQUISITE_RCODES
+            and await self._is_applied(nameserver, [qe])
+        ):
+            qe.set_nameserver_complete(address)
+            logger.info(
+                "%s (%s) applied by %s before being resent",
+                qe.filename,
+                qe.cr.change,
+                address,
+            )
+        elif response.rcode():
+            self._retry_later(address, [qe])
+            logger.warning(
+                "%s (%s) not accepted by %s",
+                qe.filename,
+                qe.cr.change,
+                address,
+            )
+        else:
+            qe.set_nameserver_complete(address)
+            logger.info(
+                "%s (%s) accepted by %s",
+                qe.filename,
+                qe.cr.change,
+                address,
+            )
+
+    async def send_batch(
+        self, nameserver: dict, batch: List[ChangeRequestQueueEntry]
+    ) -> None:
+        """Send a batch of entries for a single zone as a single UPDATE"""
+
+        if len(batch) == 1:
+            return await self.send_entry(nameserver, batch[0])
+
+        address = str(nameserver["address"])
+        breaker = self._breaker(address)
+        if breaker.is_open:
+            return
+        zone = batch[0].cr.zone
+        logger.info(
+            "Batch of %d updates for %s scheduled for update via %s",
+            len(batch),
+            zone,
+            address,
+        )
+        update = dns.update.UpdateMessage(zone)
+        for qe in batch:
+            qe.cr.add_to_message(update)
+
+        try:
+            response, resent = await self._query(nameserver, update.to_wire())
+        except Exception as exc:
+            breaker.failure()
+            self._retry_later(address, batch)
+            logger.warning(
+                "Batch of %d updates for %s not sent to %s: %s",
+                len(batch),
+                zone,
+                address,
+                str(exc) or exc.__class__.__name__,
+            )
+            return
+
+        breaker.success()
+        rcode = response.rcode()
+        if (
+            resent
+            and rcode in PREREQUISITE_RCODES
+            and await self._is_applied(nameserver, batch)
+        ):
+            for qe in batch:
+                qe.set_nameserver_complete(address)
+            logger.info(
+                "Batch of %d updates for %s applied by %s before being resent",
+                len(batch),
+                zone,
+                address,
+            )
+        elif rcode in PREREQUISITE_RCODES:
+            logger.info(
+                "Batch of %d updates for %s failed prerequisites at %s, splitting",
+                len(batch),
+                zone,
+                address,
+            )
+            middle = len(batch) // 2
+            await self.send_batch(nameserver, batch[:middle])
+            await self.send_batch(nameserver, batch[middle:])
+        elif rcode:
+            self._retry_later(address, batch)
+            logger.warning(
+                "Batch of %d updates for %s not accepted by %s (%s)",
+                len(batch),
+                zone,
+                address,
+                dns.rcode.to_text(rcode),
+            )
+        else:
+            for qe in batch:
+                qe.set_nameserver_complete(address)
+            logger.info(
+                "Batch of %d updates for %s accepted by %s",
+                len(batch),
+                zone,
+                address,
+            )
+
+
+def send_entries(
+    config: UpdaterConfig,
+    entries: List[ChangeRequestQueueEntry],
+    debug: bool = False,
+    queue: Optional[ChangeRequestQueue] = None,
+) -> None:
+    """Send entries using the asynchronous send engine"""
+
+    async def send():
+        async with UpdateSender(config, debug=debug, queue=queue) as sender:
+            await sender.send(entries)
+
+    asyncio.run(send())
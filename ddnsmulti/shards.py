@@ -0,0 +1,59 @@
+import hashlib
+import logging
+import os
+import time
+from typing import List, Optional
+
+from .queue import is_queue_file
+
+logger = logging.getLogger(__name__)
+
+SHARD_LAYOUTS = ["hash", "date"]
+DEFAULT_SHARD_LAYOUT = "hash"
+
+# Number of hex digits used for hashed shard names (256 shards)
+HASH_SHARD_WIDTH = 2
+
+SHARD_PLACEHOLDER = "{shard}"
+
+
+def shard_name(filename: str, layout: str, mtime: Optional[float] = None) -> str:
+    """Return name of shard for queue file
+
+    With the `hash` layout, files are spread over shards named by the first
+    hex digits of the SHA-256 hash of the filename. With the `date` layout,
+    files are placed in shards named by their modification date (YYYYMMDD).
+    """
+    if layout == "hash":
+        return hashlib.sha256(filename.encode()).hexdigest()[:HASH_SHARD_WIDTH]
+    if layout == "date":
+        return time.strftime("%Y%m%d", time.gmtime(mtime))
+    raise ValueError(f"Unknown shard layout: {layout}")
+
+
+def list_shards(directory: str) -> List[str]:
+    """Return names of shards (subdirectories) in queue directory"""
+    with os.scandir(directory) as it:
+        return sorted(
+            [
+                entry.name
+                for entry in it
+                if entry.is_dir() and not entry.name.startswith(".")
+            ]
+        )
+
+
+def distribute(directory: str, layout: str) -> int:
+    """Move queue files in top-level queue directory into their shards"""
+    count = 0
+    with os.scandir(directory) as it:
+        entries = [
+            entry for entry in it if is_queue_file(entry.name) and entry.is_file()
+        ]
+    for entry in entries:
+        shard = shard_name(entry.name, layout, entry.stat().st_mtime)
+        os.makedirs(os.path.join(directory, shard), exist_ok=True)
+        os.replace(entry.path, os.path.join(directory, shard, entry.name))
+        logger.debug("Moved %s to shard %s", entry.name, shard)
+        count += 1
+    return count
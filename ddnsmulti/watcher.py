@@ -0,0 +1,150 @@
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+from typing import Callable, Dict, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+INOTIFY_EVENT = struct.Struct("iIII")
+
+DEFAULT_POLL_INTERVAL = 5
+
+Callback = Callable[[Optional[Set[str]]], None]
+
+
+class PollingWatcher:
+    """Watch directory for new or changed files by listing it periodically
+
+    Files are compared by size, modification time and inode, so files still
+    being written when listed or rewritten in place are reported again. The
+    callback is called with the set of new or changed filenames.
+    """
+
+    def __init__(self, directory: str, interval: float = DEFAULT_POLL_INTERVAL) -> None:
+        self.directory = directory
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def _list(self) -> Dict[str, Tuple[int, int, int]]:
+        res = {}
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                try:
+                    if entry.is_file():
+                        st = entry.stat()
+                        res[entry.name] = (st.st_size, st.st_mtime_ns, st.st_ino)
+                except FileNotFoundError:
+                    continue
+        return res
+
+    async def _poll(self, callback: Callback) -> None:
+        known = self._list()
+        while True:
+            await asyncio.sleep(self.interval)
+            current = self._list()
+            changed = set(
+                [name for name, stat in current.items() if known.get(name) != stat]
+            )
+            if changed:
+                callback(changed)
+            known = current
+
+    def start(self, callback: Callback) -> None:
+        self._task = asyncio.create_task(self._poll(callback))
+
+    def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+class InotifyWatcher:
+    """Watch directory for new files using inotify (Linux only)
+
+    The callback is called with the set of files written or moved into the
+    directory, or with None if events were lost and the directory should be
+    rescanned.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self._fd: Optional[int] = None
+        libc_name = ctypes.util.find_library("c")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError("inotify not available")
+
+    def start(self, callback: Callback) -> None:
+        fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        wd = self._libc.inotify_add_watch(
+            fd, os.fsencode(self.directory), IN_CLOSE_WRITE | IN_MOVED_TO
+        )
+        if wd < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(errno, f"inotify_add_watch {self.directory} failed")
+        self._fd = fd
+        asyncio.get_running_loop().add_reader(fd, self._read, callback)
+
+    def _read(self, callback: Callback) -> None:
+        try:
+            data = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return
+        filenames = set()
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            start = offset + INOTIFY_EVENT.size
+            offset = start + length
+            name = data[start:offset].rstrip(b"\0")
+            if mask & IN_Q_OVERFLOW:
+                callback(None)
+                return
+            if name:
+                filenames.add(os.fsdecode(name))
+        if filenames:
+            callback(filenames)
+
+    def close(self) -> None:
+        if self._fd is not None:
+            asyncio.get_running_loop().remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+
+
+def start_watcher(
+    directory: str,
+    callback: Callback,
+    method: str = "auto",
+    interval: float = DEFAULT_POLL_INTERVAL,
+):
+    """Start and return watcher for directory, using inotify if available
+
+    In `auto` mode, polling is used if inotify is not available or the
+    directory cannot be watched (for example when inotify limits are
+    exhausted).
+    """
+    if method in ["auto", "inotify"]:
+        try:
+            watcher = InotifyWatcher(directory)
+            watcher.start(callback)
+            return watcher
+        except OSError as exc:
+            if method == "inotify":
+                raise
+            logger.info("inotify not available (%s), using polling", str(exc))
+    watcher = PollingWatcher(directory, interval)
+    watcher.start(callback)
+    return watcher
@@ -0,0 +1,94 @@
+import logging
+import struct
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import dns.rdataclass
+import dns.rdatatype
+import dns.rdtypes.ANY.TSIG
+import dns.tsig
+
+from .queue import ChangeRequestQueueEntry
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = 10000
+TSIG_FUDGE = 300
+
+# Size of TSIG record excluding owner name, algorithm name and MAC
+TSIG_FIXED_SIZE = 26
+TSIG_MAX_MAC_SIZE = 64
+
+
+def signed_size(wire: bytes, key: Optional[dns.tsig.Key] = None) -> int:
+    """Return size of message in wire format once signed using key"""
+    if key is None:
+        return len(wire)
+    return (
+        len(wire)
+        + len(key.name.to_wire())
+        + len(key.algorithm.to_wire())
+        + TSIG_FIXED_SIZE
+        + dns.tsig.mac_sizes.get(key.algorithm, TSIG_MAX_MAC_SIZE)
+    )
+
+
+def sign_wire(
+    wire: bytes, qid: int, key: Optional[dns.tsig.Key] = None
+) -> Tuple[bytes, Optional[bytes]]:
+    """Set message ID of unsigned message in wire format and sign it
+
+    Returns signed message and request MAC (needed to verify the response).
+    """
+
+    wire = struct.pack("!H", qid) + wire[2:]
+    if key is None:
+        return (wire, None)
+
+    tsig = dns.rdtypes.ANY.TSIG.TSIG(
+        dns.rdataclass.ANY,
+        dns.rdatatype.TSIG,
+        key.algorithm,
+        0,
+        TSIG_FUDGE,
+        b"",
+        qid,
+        0,
+        b"",
+    )
+    tsig, _ = dns.tsig.sign(wire, key, tsig, int(time.time()))
+    rdata = tsig.to_wire()
+    record = (
+        key.name.to_wire()
+        + struct.pack("!HHIH", dns.rdatatype.TSIG, dns.rdataclass.ANY, 0, len(rdata))
+        + rdata
+    )
+    (arcount,) = struct.unpack_from("!H", wire, 10)
+    wire = wire[:10] + struct.pack("!H", arcount + 1) + wire[12:] + record
+    return (wire, tsig.mac)
+
+
+class MessageCache:
+    """Cache of unsigned UPDATE messages in wire format, keyed by fingerprint
+
+    The least recently used messages are evicted when the cache is full.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self._messages: OrderedDict[str, bytes] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def get(self, qe: ChangeRequestQueueEntry) -> bytes:
+        """Return unsigned message for entry"""
+        if (wire := self._messages.get(qe.fingerprint)) is not None:
+            self._messages.move_to_end(qe.fingerprint)
+            return wire
+        wire = qe.cr.to_message().to_wire()
+        self._messages[qe.fingerprint] = wire
+        if len(self._messages) > self.max_size:
+            self._messages.popitem(last=False)
+        return wire
@@ -0,0 +1,175 @@
+import asyncio
+import dataclasses
+import logging
+import multiprocessing
+from queue import Empty
+from typing import Dict, List, Optional
+
+from .config import UpdaterConfig
+from .metrics import CONVERGENCE_DURATION, REGISTRY
+from .queue import ChangeRequestQueue, ChangeRequestQueueEntry
+from .sender import UpdateSender, observe_convergence
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for status reports before checking that workers are alive
+STATUS_POLL_INTERVAL = 1
+
+
+def partition(nameservers: List[dict], workers: int) -> List[List[dict]]:
+    """Split nameservers round-robin into at most `workers` groups"""
+    count = max(1, min(workers, len(nameservers)))
+    return [nameservers[n::count] for n in range(count)]
+
+
+class StatusReporter:
+    """Report status changes of entries in a worker process to the coordinator
+
+    Takes the place of the queue of the entries sent by the worker, and of
+    the queue holding the circuit breaker state.
+    """
+
+    def __init__(
+        self, status_queue: multiprocessing.Queue, breakers: Dict[str, float]
+    ) -> None:
+        self.status_queue = status_queue
+        self.breakers = breakers
+
+    def nameserver_changed(self, qe: ChangeRequestQueueEntry, address: str) -> None:
+        self.status_queue.put(
+            (
+                "status",
+                qe.filename,
+                address,
+                qe.nameservers[address],
+                qe.retries.get(address),
+            )
+        )
+
+    def nameserver_verified(self, qe: ChangeRequestQueueEntry, address: str) -> None:
+        self.status_queue.put(("verified", qe.filename, address, qe.verified[address]))
+
+    def set_breaker(self, address: str, open_until: Optional[float]) -> None:
+        self.status_queue.put(("breaker", address, open_until))
+
+
+def run_worker(
+    config: UpdaterConfig,
+    entries: List[dict],
+    status_queue: multiprocessing.Queue,
+    breakers: Dict[str, float],
+    debug: bool = False,
+) -> None:
+    """Send entries to the nameservers of config (in a worker process)
+
+    Metrics recorded while sending are reported to the coordinator when done,
+    except convergence: a worker only sees verification by its own nameservers.
+    """
+
+    # drop values inherited from the coordinator, only report our own
+    REGISTRY.clear()
+    reporter = StatusReporter(status_queue, breakers)
+    queue_entries = []
+    for data in entries:
+        qe = ChangeRequestQueueEntry.from_dict(data)
+        qe.queue = reporter
+        queue_entries.append(qe)
+
+    async def send():
+        async with UpdateSender(config, debug=debug, queue=reporter) as sender:
+            await sender.send(queue_entries)
+
+    try:
+        asyncio.run(send())
+    finally:
+        CONVERGENCE_DURATION.clear()
+        status_queue.put(("metrics", REGISTRY.snapshot()))
+        status_queue.put(("done",))
+
+
+def _apply_status(
+    files: Dict[str, ChangeRequestQueueEntry],
+    queue: Optional[ChangeRequestQueue],
+    message: tuple,
+    verify_addresses: List[str],
+) -> None:
+    if message[0] == "status":
+        _, filename, address, value, retry = message
+        files[filename].set_nameserver_status(address, value, retry)
+    elif message[0] == "verified":
+        _, filename, address, value = message
+        files[filename].set_nameserver_verified(address, value)
+        observe_convergence(files[filename], verify_addresses)
+    elif message[0] == "breaker":
+        _, address, open_until = message
+        if queue is not None:
+            queue.set_breaker(address, open_until)
+    elif message[0] == "metrics":
+        REGISTRY.merge(message[1])
+
+
+def send_entries_parallel(
+    config: UpdaterConfig,
+    entries: List[ChangeRequestQueueEntry],
+    workers: int,
+    debug: bool = False,
+    queue: Optional[ChangeRequestQueue] = None,
+) -> None:
+    """Send entries using one worker process per group of nameservers
+
+    Each worker has its own send engine and connections. Status changes are
+    reported back as they happen and applied to the entries (and thereby
+    their queue) by this process, metrics are merged into its registry.
+    Convergence is recorded here, against all verifying nameservers.
+    Circuit breaker state is read from and recorded in `queue`, if given.
+    """
+
+    files = {qe.filename: qe for qe in entries if qe}
+    data = [qe.as_dict(wire=True) for qe in files.values()]
+    status_queue = multiprocessing.Queue()
+    verify_addresses = config.verify_addresses
+    processes = [
+        multiprocessing.Process(
+            target=run_worker,
+            args=(
+                dataclasses.replace(config, nameservers=nameservers),
+                data,
+                status_queue,
+                dict(queue.breakers) if queue is not None else {},
+                debug,
+            ),
+            name=f"ddnsmulti-send-{n}",
+        )
+        for n, nameservers in enumerate(partition(config.nameservers, workers))
+    ]
+    for process in processes:
+        process.start()
+    logger.info("Started %d send workers", len(processes))
+
+    running = len(processes)
+    while running:
+        try:
+            message = status_queue.get(timeout=STATUS_POLL_INTERVAL)
+        except Empty:
+            if any([process.is_alive() for process in processes]):
+                continue
+            # workers terminated without reporting, apply what was reported
+            while True:
+                try:
+                    _apply_status(
+                        files, queue, status_queue.get_nowait(), verify_addresses
+                    )
+                except Empty:
+                    break
+            break
+        if message[0] == "done":
+            running -= 1
+        else:
+            _apply_status(files, queue, message, verify_addresses)
+
+    for process in processes:
+        process.join()
+        if process.exitcode:
+            logger.error(
+                "Send worker %s failed (exit code %d)", process.name, process.exitcode
+            )
@@ -0,0 +1,205 @@
+"""In-process DNS UPDATE responder for tests and benchmarks
+
+Answers UPDATE messages over TCP (and optionally UDP) without applying them,
+verifying TSIG signatures if a keyring is given. Requests can be delayed,
+dropped (to simulate timeouts) or refused at random. If a zone is given,
+zone transfers are answered with the whole zone and queries are answered
+from the zone.
+"""
+
+import asyncio
+import random
+import struct
+from typing import Optional, Set
+
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.opcode
+import dns.rcode
+import dns.rdatatype
+import dns.tsig
+import dns.zone
+
+
+class FakeServer:
+    """Minimal DNS UPDATE responder over TCP (and optionally UDP)
+
+    Received UPDATE requests are kept in `received` and `received_udp`,
+    unless `record` is False (for benchmarks sending many updates). The
+    `requests`, `dropped`, `refused` and `bad_tsig` counters are always kept.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        rcode: int = dns.rcode.NOERROR,
+        reject: Set[str] = set(),
+        keyring: Optional[dns.tsig.Key] = None,
+        silent: bool = False,
+        udp: bool = False,
+        truncate: bool = False,
+        silent_udp: bool = False,
+        zone: Optional[dns.zone.Zone] = None,
+        latency: float = 0,
+        failure_rate: float = 0,
+        refused_rate: float = 0,
+        record: bool = True,
+    ) -> None:
+        self.host = host
+        self.keyring = keyring
+        self.silent = silent
+        self.udp = udp
+        self.truncate = truncate
+        self.silent_udp = silent_udp
+        self.zone = zone
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.refused_rate = refused_rate
+        self.record = record
+        self.transfers = []
+        self.queries = []
+        self.rcode = rcode
+        self.reject = set([dns.name.from_text(name) for name in reject])
+        self.received = []
+        self.received_udp = []
+        self.requests = 0
+        self.dropped = 0
+        self.refused = 0
+        self.bad_tsig = 0
+        self.connections = 0
+        self.server = None
+        self.datagram_transport = None
+
+    @property
+    def port(self) -> int:
+        return self.server.sockets[0].getsockname()[1]
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(self.handle, self.host, 0)
+        if self.udp:
+            loop = asyncio.get_running_loop()
+            self.datagram_transport, _ = await loop.create_datagram_endpoint(
+                lambda: FakeDatagramProtocol(self), local_addr=(self.host, self.port)
+            )
+
+    async def stop(self) -> None:
+        if self.datagram_transport is not None:
+            self.datagram_transport.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def respond(self, wire: bytes, udp: bool = False) -> Optional[bytes]:
+        """Return response to request, or None if it should be dropped"""
+        try:
+            request = dns.message.from_wire(wire, keyring=self.keyring)
+        except dns.exception.DNSException:
+            self.bad_tsig += 1
+            return None
+        if request.question and request.question[0].rdtype in (
+            dns.rdatatype.AXFR,
+            dns.rdatatype.IXFR,
+        ):
+            return self.transfer(request)
+        if self.zone is not None and request.opcode() == dns.opcode.QUERY:
+            return self.lookup(request)
+
+        self.requests += 1
+        if self.record:
+            (self.received_udp if udp else self.received).append(request)
+        if self.silent or (self.silent_udp and udp):
+            return None
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            self.dropped += 1
+            return None
+        response = dns.message.make_response(request)
+        if self.reject & set([r.name for r in request.prerequisite]):
+            response.set_rcode(dns.rcode.NXRRSET)
+        elif self.refused_rate and random.random() < self.refused_rate:
+            self.refused += 1
+            response.set_rcode(dns.rcode.REFUSED)
+        else:
+            response.set_rcode(self.rcode)
+        if self.truncate and udp:
+            response.flags |= dns.flags.TC
+        return response.to_wire()
+
+    def lookup(self, request: dns.message.Message) -> bytes:
+        self.queries.append(request)
+        response = dns.message.make_response(request)
+        question = request.question[0]
+        if rdataset := self.zone.get_rdataset(question.name, question.rdtype):
+            response.find_rrset(
+                response.answer,
+                question.name,
+                rdataset.rdclass,
+                rdataset.rdtype,
+                create=True,
+            ).update(rdataset)
+        return response.to_wire()
+
+    def transfer(self, request: dns.message.Message) -> bytes:
+        self.transfers.append(request)
+        response = dns.message.make_response(request)
+        soa = self.zone.find_rrset(self.zone.origin, dns.rdatatype.SOA)
+        response.answer.append(soa)
+        for name, rdataset in self.zone.iterate_rdatasets():
+            if rdataset.rdtype != dns.rdatatype.SOA:
+                response.find_rrset(
+                    response.answer,
+                    name,
+                    rdataset.rdclass,
+                    rdataset.rdtype,
+                    create=True,
+                ).update(rdataset)
+        response.answer.append(soa)
+        return response.to_wire()
+
+    async def handle(self, reader, writer) -> None:
+        """Answer requests on a TCP connection, concurrently if delayed"""
+        self.connections += 1
+        write_lock = asyncio.Lock()
+        tasks = set()
+
+        async def answer(wire: bytes) -> None:
+            if (response := await self.respond(wire)) is not None:
+                async with write_lock:
+                    writer.write(struct.pack("!H", len(response)) + response)
+                    await writer.drain()
+
+        try:
+            while True:
+                (length,) = struct.unpack("!H", await reader.readexactly(2))
+                wire = await reader.readexactly(length)
+                if self.latency:
+                    task = asyncio.create_task(answer(wire))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                else:
+                    await answer(wire)
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+
+class FakeDatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server: FakeServer) -> None:
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        asyncio.create_task(self._respond(data, addr))
+
+    async def _respond(self, data: bytes, addr) -> None:
+        if (wire := await self.server.respond(data, udp=True)) is not None:
+            if not self.transport.is_closing():
+                self.transport.sendto(wire, addr)
@@ -125,6 +125,20 @@ class TestChangeRequest(unittest.TestCase):
         message = cr.to_message()
         print(message)
 
+    def test_ddns_rdata_diff(self):
+        cr = ChangeRequest.from_yaml(CHANGE_REQUEST)
+        nsupdate = cr.to_nsupdate().splitlines()
+        self.assertIn("update delete a.example.com. IN NS ns2.a.example.com.", nsupdate)
+        self.assertIn(
+            "update add a.example.com. 86400 IN NS ns4.a.example.com.", nsupdate
+        )
+        self.assertNotIn(
+            "update delete a.example.com. IN NS ns1.a.example.com.", nsupdate
+        )
+        message = cr.to_message()
+        self.assertEqual(sum([len(rrset) for rrset in message.prerequisite]), 5)
+        self.assertEqual(sum([len(rrset) for rrset in message.update]), 5)
+
     def test_nsupdate(self):
         cr = ChangeRequest.from_yaml(CHANGE_REQUEST)
         nsupdate = cr.to_nsupdate()
@@ -24,6 +24,14 @@ class TestConfig(unittest.TestCase):
     def test_validate(self):
         _ = UpdaterConfig.from_yaml(CONFIG_EXAMPLE)
 
+    def test_contexts(self):
+        config = UpdaterConfig.from_yaml(CONFIG_EXAMPLE)
+        context = config.contexts["10.0.0.1"]
+        self.assertIs(config.contexts["10.0.0.1"], context)
+        self.assertEqual(context.port, 53)
+        self.assertEqual(context.transport, "tcp")
+        self.assertEqual(str(context.key.name), "test-20230201.")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,135 @@
+import asyncio
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from fakeserver import FakeServer
+
+from ddnsmulti.config import UpdaterConfig
+from ddnsmulti.daemon import UpdaterDaemon
+from ddnsmulti.queue import ChangeRequestQueue
+from ddnsmulti.watcher import InotifyWatcher
+
+BASEDIR = os.path.abspath(os.path.dirname(__file__))
+QUEUEDIR = os.path.join(BASEDIR, "queue")
+
+CONFIG_TEMPLATE = """
+queuedir: {queuedir}
+index: {index}
+daemon:
+  retry_interval: 3600
+  poll_interval: 0.05
+  watch: {watch}
+nameservers:
+  - address: 127.0.0.1
+    port: {port}
+"""
+
+
+class TestDaemon(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = FakeServer("127.0.0.1")
+        await self.server.start()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.queuedir = os.path.join(self.tmpdir.name, "queue")
+        self.index = os.path.join(self.tmpdir.name, "index.json")
+        os.mkdir(self.queuedir)
+
+    async def asyncTearDown(self):
+        await self.server.stop()
+        self.tmpdir.cleanup()
+
+    async def run_daemon(self, watch: str):
+        config = UpdaterConfig.from_yaml(
+            CONFIG_TEMPLATE.format(
+                queuedir=self.queuedir,
+                index=self.index,
+                watch=watch,
+                port=self.server.port,
+            )
+        )
+        daemon = UpdaterDaemon(config)
+        task = asyncio.create_task(daemon.run())
+        await asyncio.sleep(0.1)
+
+        for filename in ["1.yaml", "2.yaml"]:
+            tmp_filename = os.path.join(self.tmpdir.name, filename)
+            shutil.copy(os.path.join(QUEUEDIR, filename), tmp_filename)
+            os.rename(tmp_filename, os.path.join(self.queuedir, filename))
+
+        for _ in range(100):
+            if len(self.server.received) == 2:
+                break
+            await asyncio.sleep(0.05)
+
+        daemon.stop()
+        await task
+        self.assertEqual(len(self.server.received), 2)
+
+        queue = ChangeRequestQueue(queue_directory=self.queuedir, index=self.index)
+        queue.load_index()
+        self.assertEqual(len(queue), 2)
+        for qe in queue:
+            self.assertTrue(qe.is_complete(["127.0.0.1"]))
+
+    async def test_inotify(self):
+        await self.run_daemon("auto")
+
+    async def test_poll(self):
+        await self.run_daemon("poll")
+
+    async def test_inotify_unavailable(self):
+        error = OSError(errno.ENOSPC, "inotify_add_watch failed")
+        with mock.patch.object(InotifyWatcher, "start", side_effect=error):
+            # auto falls back to polling
+            await self.run_daemon("auto")
+
+            config = UpdaterConfig.from_yaml(
+                CONFIG_TEMPLATE.format(
+                    queuedir=self.queuedir,
+                    index=self.index,
+                    watch="inotify",
+                    port=self.server.port,
+                )
+            )
+            with self.assertRaises(OSError):
+                await UpdaterDaemon(config).run()
+
+    async def test_poll_rewritten(self):
+        config = UpdaterConfig.from_yaml(
+            CONFIG_TEMPLATE.format(
+                queuedir=self.queuedir,
+                index=self.index,
+                watch="poll",
+                port=self.server.port,
+            )
+        )
+        daemon = UpdaterDaemon(config)
+        task = asyncio.create_task(daemon.run())
+        await asyncio.sleep(0.1)
+
+        with open(os.path.join(QUEUEDIR, "1.yaml")) as input_file:
+            contents = input_file.read()
+        filename = os.path.join(self.queuedir, "1.yaml")
+        # file caught by the watcher while still being written
+        with open(filename, "w") as output_file:
+            output_file.write(contents[: len(contents) // 2])
+        await asyncio.sleep(0.2)
+        with open(filename, "w") as output_file:
+            output_file.write(contents)
+
+        for _ in range(100):
+            if len(self.server.received) == 1:
+                break
+            await asyncio.sleep(0.05)
+
+        daemon.stop()
+        await task
+        self.assertEqual(len(self.server.received), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
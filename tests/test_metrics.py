@@ -0,0 +1,85 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from ddnsmulti.metrics import Counter, Gauge, Histogram, MetricsServer, Registry
+
+
+class TestMetrics(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.registry = Registry()
+        self.counter = Counter(
+            "test_responses_total", "Responses", ["rcode"], registry=self.registry
+        )
+        self.gauge = Gauge("test_entries", "Entries", registry=self.registry)
+        self.histogram = Histogram(
+            "test_duration_seconds",
+            "Duration",
+            ["nameserver"],
+            buckets=[0.1, 1],
+            registry=self.registry,
+        )
+
+    def test_render(self):
+        self.counter.labels("NOERROR").inc()
+        self.counter.labels("NOERROR").inc()
+        self.counter.labels('"REFUSED"').inc()
+        self.gauge.set(42)
+        self.histogram.labels("10.0.0.1").observe(0.05)
+        self.histogram.labels("10.0.0.1").observe(0.1)
+        self.histogram.labels("10.0.0.1").observe(5)
+        lines = self.registry.render().splitlines()
+        self.assertIn("# TYPE test_responses_total counter", lines)
+        self.assertIn('test_responses_total{rcode="NOERROR"} 2', lines)
+        self.assertIn('test_responses_total{rcode="\\"REFUSED\\""} 1', lines)
+        self.assertIn("test_entries 42", lines)
+        self.assertIn(
+            'test_duration_seconds_bucket{nameserver="10.0.0.1",le="0.1"} 2', lines
+        )
+        self.assertIn(
+            'test_duration_seconds_bucket{nameserver="10.0.0.1",le="+Inf"} 3', lines
+        )
+        self.assertIn('test_duration_seconds_count{nameserver="10.0.0.1"} 3', lines)
+        with self.assertRaises(ValueError):
+            self.counter.labels()
+
+    def test_merge(self):
+        self.counter.labels("NOERROR").inc()
+        self.histogram.labels("10.0.0.1").observe(0.05)
+        snapshot = self.registry.snapshot()
+        self.registry.clear()
+        self.gauge.set(1)
+        self.counter.labels("NOERROR").inc(2)
+        self.registry.merge(snapshot)
+        lines = self.registry.render().splitlines()
+        self.assertIn('test_responses_total{rcode="NOERROR"} 3', lines)
+        self.assertIn("test_entries 1", lines)
+        self.assertIn('test_duration_seconds_count{nameserver="10.0.0.1"} 1', lines)
+
+    def test_textfile(self):
+        self.gauge.set(1)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "ddnsmulti.prom")
+            self.registry.write_textfile(filename)
+            with open(filename) as input_file:
+                self.assertEqual(input_file.read(), self.registry.render())
+            self.assertEqual(os.listdir(tmpdir), ["ddnsmulti.prom"])
+
+    async def test_server(self):
+        server = MetricsServer(
+            "127.0.0.1", 0, registry=self.registry, collect=lambda: self.gauge.set(7)
+        )
+        await server.start()
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+        writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        response = await reader.read()
+        writer.close()
+        await server.close()
+        self.assertTrue(response.startswith(b"HTTP/1.0 200 OK\r\n"))
+        self.assertIn(b"\r\n\r\n# HELP test_responses_total", response)
+        self.assertIn(b"\ntest_entries 7\n", response)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,14 @@
+import json
 import logging
 import os
+import shutil
+import tempfile
 import unittest
 
-from ddnsmulti.queue import ChangeRequestQueue
+import yaml
+
+from ddnsmulti.index import JOURNAL_SUFFIX, get_index
+from ddnsmulti.queue import ARCHIVE_FILENAME, ChangeRequestQueue
 
 BASEDIR = os.path.abspath(os.path.dirname(__file__))
 QUEUEDIR = os.path.join(BASEDIR, "queue")
@@ -43,6 +49,426 @@ class TestQueue(unittest.TestCase):
 
         queue.save_index()
 
+    def test_parallel(self):
+        serial = ChangeRequestQueue(queue_directory=QUEUEDIR)
+        serial.update_queue()
+        parallel = ChangeRequestQueue(queue_directory=QUEUEDIR, workers=2)
+        parallel.update_queue()
+        self.assertEqual(
+            [(qe.filename, qe.fingerprint) for qe in serial],
+            [(qe.filename, qe.fingerprint) for qe in parallel],
+        )
+        for qe in parallel:
+            self.assertIn("cr", qe.__dict__)
+            self.assertIs(qe.queue, parallel)
+
+    def test_lazy(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index_filename = os.path.join(tmpdir, INDEX)
+            queue = ChangeRequestQueue(queue_directory=QUEUEDIR, index=index_filename)
+            queue.load_index()
+            queue.update_queue()
+            queue.save_index()
+            queue.load_index()
+            for qe in queue:
+                self.assertNotIn("cr", qe.__dict__)
+                self.assertEqual(qe.cr.change.to_text(), qe.change)
+                self.assertEqual(qe.cr.zone.to_text(), qe.zone)
+
+    def test_journal(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index_filename = os.path.join(tmpdir, INDEX)
+            queue = ChangeRequestQueue(
+                queue_directory=QUEUEDIR, index=index_filename, index_format="journal"
+            )
+            queue.load_index()
+            queue.update_queue()
+            queue.save_index()
+            self.assertFalse(os.path.exists(index_filename))
+            # generation of the snapshot, then one record per entry
+            with open(index_filename + JOURNAL_SUFFIX) as journal:
+                self.assertEqual(len(journal.readlines()), 1 + len(queue))
+
+            queue.load_index()
+            self.assertEqual(len(queue), 2)
+            for qe in queue:
+                qe.set_nameserver_complete("10.0.0.1")
+            queue.save_index()
+            with open(index_filename + JOURNAL_SUFFIX) as journal:
+                self.assertEqual(len(journal.readlines()), 1 + 2 * len(queue))
+
+            queue.index.compact(queue)
+            queue.load_index()
+            self.assertEqual(len(queue), 2)
+            for qe in queue:
+                self.assertFalse(qe.is_pending("10.0.0.1"))
+                self.assertTrue(qe.is_pending("10.0.0.2"))
+            self.assertEqual(os.path.getsize(index_filename + JOURNAL_SUFFIX), 0)
+
+            first, second = sorted(queue, key=lambda qe: qe.filename)
+            first.set_nameserver_verified("10.0.0.1")
+            second.set_nameserver_verified("10.0.0.1")
+            second.set_nameserver_complete("10.0.0.1")
+            queue.save_index()
+            queue.load_index()
+            first, second = sorted(queue, key=lambda qe: qe.filename)
+            self.assertTrue(first.is_verified("10.0.0.1"))
+            self.assertFalse(second.is_verified("10.0.0.1"))
+
+    def test_journal_recovery(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            index_filename = os.path.join(tmpdir, INDEX)
+            journal_filename = index_filename + JOURNAL_SUFFIX
+            queue = ChangeRequestQueue(
+                queue_directory=QUEUEDIR, index=index_filename, index_format="journal"
+            )
+            queue.load_index()
+            queue.update_queue()
+            queue.save_index()
+
+            # record torn by an interrupted save
+            with open(journal_filename, "ab") as journal:
+                journal.write(b'{"op": "stat", "fil')
+            queue.load_index()
+            for qe in queue:
+                qe.set_nameserver_complete("10.0.0.1")
+            queue.save_index()
+            queue.load_index()
+            self.assertEqual(len(queue), 2)
+            for qe in queue:
+                self.assertFalse(qe.is_pending("10.0.0.1"))
+
+            # compaction interrupted before the journal was truncated
+            shutil.copy(journal_filename, os.path.join(tmpdir, "journal"))
+            for qe in queue:
+                qe.set_nameserver_incomplete("10.0.0.1")
+            queue.index.compact(queue)
+            shutil.copy(os.path.join(tmpdir, "journal"), journal_filename)
+            queue.load_index()
+            for qe in queue:
+                self.assertTrue(qe.is_pending("10.0.0.1"))
+            queue[0].set_nameserver_complete("10.0.0.2")
+            queue.save_index()
+            queue.load_index()
+            self.assertFalse(queue[0].is_pending("10.0.0.2"))
+            self.assertTrue(queue[0].is_pending("10.0.0.1"))
+
+    def test_msgpack(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            json_filename = os.path.join(tmpdir, INDEX)
+            msgpack_filename = os.path.join(tmpdir, "index.msgpack")
+            queue = ChangeRequestQueue(queue_directory=QUEUEDIR, index=json_filename)
+            queue.load_index()
+            queue.update_queue()
+            queue.save_index()
+            get_index(msgpack_filename, "msgpack").compact(queue)
+
+            converted = ChangeRequestQueue(
+                queue_directory=QUEUEDIR,
+                index=msgpack_filename,
+                index_format="msgpack",
+            )
+            converted.load_index()
+            self.assertEqual(len(converted), len(queue))
+            for qe in converted:
+                self.assertIsNone(qe.yaml_str)
+                original = queue.files[qe.filename]
+                self.assertEqual(qe.fingerprint, original.fingerprint)
+                self.assertEqual(qe.cr.from_index, original.cr.from_index)
+                self.assertEqual(qe.cr.to_index, original.cr.to_index)
+                qe.set_nameserver_complete("10.0.0.1")
+            converted.save_index()
+            converted.update_queue()
+            self.assertEqual(converted.changes, [])
+
+            os.unlink(json_filename)
+            get_index(json_filename, "json").compact(converted)
+            queue.load_index()
+            for qe in queue:
+                self.assertFalse(qe.is_pending("10.0.0.1"))
+                self.assertEqual(
+                    qe.cr.to_index, converted.files[qe.filename].cr.to_index
+                )
+
+    def test_msgpack_bulk(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            queuedir = os.path.join(tmpdir, "queue")
+            os.mkdir(queuedir)
+            with open(os.path.join(queuedir, "bulk.ndjson"), "wt") as output_file:
+                for filename in ["1.yaml", "2.yaml"]:
+                    with open(os.path.join(QUEUEDIR, filename)) as input_file:
+                        document = yaml.safe_load(input_file)
+                    output_file.write(json.dumps(document) + "\n")
+            json_filename = os.path.join(tmpdir, INDEX)
+            msgpack_filename = os.path.join(tmpdir, "index.msgpack")
+            queue = ChangeRequestQueue(queue_directory=queuedir, index=json_filename)
+            queue.update_queue()
+            get_index(msgpack_filename, "msgpack").compact(queue)
+
+            converted = ChangeRequestQueue(
+                queue_directory=queuedir,
+                index=msgpack_filename,
+                index_format="msgpack",
+            )
+            converted.load_index()
+            get_index(json_filename, "json").compact(converted)
+
+            reloaded = ChangeRequestQueue(queue_directory=queuedir, index=json_filename)
+            reloaded.load_index()
+            self.assertEqual(len(reloaded), 2)
+            for qe in reloaded:
+                self.assertEqual(qe.cr.to_index, queue.files[qe.filename].cr.to_index)
+            get_index(msgpack_filename, "msgpack").compact(reloaded)
+            converted.load_index()
+            for qe in converted:
+                self.assertEqual(qe.cr.to_index, queue.files[qe.filename].cr.to_index)
+
+    def test_concurrent_save(self):
+        for index_format in ["json", "journal", "msgpack"]:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                index_filename = os.path.join(tmpdir, INDEX)
+                first = ChangeRequestQueue(
+                    queue_directory=QUEUEDIR,
+                    index=index_filename,
+                    index_format=index_format,
+                )
+                first.load_index()
+                first.update_queue()
+                first.save_index()
+
+                second = ChangeRequestQueue(
+                    queue_directory=QUEUEDIR,
+                    index=index_filename,
+                    index_format=index_format,
+                )
+                second.load_index()
+                first[0].set_nameserver_complete("10.0.0.1")
+                first.set_breaker("10.0.0.3", 100.0)
+                first.save_index()
+                second[0].set_nameserver_incomplete("10.0.0.1", retry_after=60)
+                second[1].set_nameserver_complete("10.0.0.2")
+                second.set_breaker("10.0.0.4", 200.0)
+                second.save_index()
+
+                # second queue is reloaded with merged changes
+                breakers = {"10.0.0.3": 100.0, "10.0.0.4": 200.0}
+                self.assertFalse(second[0].is_pending("10.0.0.1"))
+                self.assertFalse(second[1].is_pending("10.0.0.2"))
+                self.assertEqual(second.breakers, breakers)
+                first.load_index()
+                self.assertFalse(first[0].is_pending("10.0.0.1"))
+                self.assertFalse(first[1].is_pending("10.0.0.2"))
+                self.assertEqual(first.breakers, breakers)
+
+                first.set_breaker("10.0.0.3", None)
+                first.save_index()
+                first.load_index()
+                self.assertEqual(first.breakers, {"10.0.0.4": 200.0})
+                self.assertFalse([f for f in os.listdir(tmpdir) if f.endswith(".tmp")])
+
+    def test_backlog(self):
+        NAMESERVERS = ["10.0.0.1", "10.0.0.2"]
+        queue = ChangeRequestQueue(queue_directory=QUEUEDIR, nameservers=NAMESERVERS)
+        queue.update_queue()
+        first, second = list(queue)
+        self.assertEqual(queue.pending_for("10.0.0.1"), [first, second])
+        self.assertEqual(queue.lag("10.0.0.1")[0], 2)
+
+        first.set_nameserver_complete("10.0.0.1")
+        self.assertEqual(queue.pending_for("10.0.0.1"), [second])
+        self.assertEqual(queue.pending(), [first, second])
+        first.set_nameserver_complete("10.0.0.2")
+        self.assertEqual(queue.pending(), [second])
+
+        second.set_nameserver_complete("10.0.0.1")
+        first.set_nameserver_incomplete("10.0.0.1")
+        second.set_nameserver_incomplete("10.0.0.1")
+        self.assertEqual(queue.pending_for("10.0.0.1"), [first, second])
+        self.assertEqual(queue.lag("10.0.0.2")[0], 1)
+
+    def test_priority(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            queuedir = os.path.join(tmpdir, "queue")
+            shutil.copytree(QUEUEDIR, queuedir)
+            with open(os.path.join(queuedir, "2.yaml"), "at") as output_file:
+                output_file.write("\npriority: 0\n")
+            index_filename = os.path.join(tmpdir, INDEX)
+            queue = ChangeRequestQueue(
+                queue_directory=queuedir,
+                index=index_filename,
+                nameservers=["10.0.0.1"],
+            )
+            queue.update_queue()
+            first, second = sorted(queue, key=lambda qe: qe.filename)
+            self.assertEqual(second.priority, 0)
+            self.assertEqual(queue.pending_for("10.0.0.1"), [second, first])
+            self.assertEqual(queue.pending(), [second, first])
+            queue.save_index()
+
+            queue = ChangeRequestQueue(
+                queue_directory=queuedir,
+                index=index_filename,
+                nameservers=["10.0.0.1"],
+            )
+            queue.load_index()
+            self.assertEqual(
+                [qe.filename for qe in queue.pending()], ["2.yaml", "1.yaml"]
+            )
+
+    def test_changed_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            queuedir = os.path.join(tmpdir, "queue")
+            shutil.copytree(QUEUEDIR, queuedir)
+            index_filename = os.path.join(tmpdir, INDEX)
+            queue = ChangeRequestQueue(queue_directory=queuedir, index=index_filename)
+            queue.load_index()
+            queue.update_queue()
+            for qe in queue:
+                qe.set_nameserver_complete("10.0.0.1")
+            queue.save_index()
+            fingerprints = [qe.fingerprint for qe in queue]
+
+            # same content, new signature
+            filename = os.path.join(queuedir, "1.yaml")
+            os.utime(filename, ns=(0, 0))
+            queue.load_index()
+            queue.update_queue()
+            self.assertEqual([qe.fingerprint for qe in queue], fingerprints)
+            self.assertEqual(queue[0].stat[1], 0)
+            self.assertFalse(queue[0].is_pending("10.0.0.1"))
+
+            # new content
+            with open(filename, "at") as output_file:
+                output_file.write("# changed\n")
+            queue.update_queue()
+            queue.save_index()
+            queue.load_index()
+            self.assertEqual(len(queue), 2)
+            self.assertEqual(queue[0].filename, "1.yaml")
+            self.assertNotEqual(queue[0].fingerprint, fingerprints[0])
+            self.assertTrue(queue[0].is_pending("10.0.0.1"))
+            self.assertEqual(queue[1].fingerprint, fingerprints[1])
+
+    def test_prune(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            queuedir = os.path.join(tmpdir, "queue")
+            archivedir = os.path.join(tmpdir, "archive")
+            shutil.copytree(QUEUEDIR, queuedir)
+            os.mkdir(archivedir)
+            index_filename = os.path.join(tmpdir, INDEX)
+            queue = ChangeRequestQueue(queue_directory=queuedir, index=index_filename)
+            queue.load_index()
+            queue.update_queue()
+
+            NAMESERVERS = ["10.0.0.1", "10.0.0.2"]
+            self.assertEqual(len(queue.pending(NAMESERVERS)), 2)
+            for qe in queue:
+                for n in NAMESERVERS:
+                    qe.set_nameserver_complete(n)
+            self.assertEqual(len(queue.pending(NAMESERVERS)), 0)
+
+            # entries are kept until verified
+            self.assertEqual(
+                queue.prune(NAMESERVERS, archivedir, verify=["10.0.0.2"]), 0
+            )
+            for qe in queue:
+                qe.set_nameserver_verified("10.0.0.2")
+            self.assertEqual(queue.prune(NAMESERVERS, archivedir, max_age=3600), 0)
+            self.assertEqual(
+                queue.prune(
+                    NAMESERVERS, archivedir, max_entries=1, verify=["10.0.0.2"]
+                ),
+                1,
+            )
+            queue.save_index()
+
+            queue.load_index()
+            queue.update_queue()
+            self.assertEqual(len(queue), 1)
+            self.assertEqual(len(os.listdir(archivedir)), 2)
+            with open(os.path.join(archivedir, ARCHIVE_FILENAME)) as archive:
+                self.assertEqual(len(archive.readlines()), 1)
+
+    def test_prune_removed_nameserver(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            queuedir = os.path.join(tmpdir, "queue")
+            archivedir = os.path.join(tmpdir, "archive")
+            shutil.copytree(QUEUEDIR, queuedir)
+            os.mkdir(archivedir)
+            queue = ChangeRequestQueue(
+                queue_directory=queuedir, index=os.path.join(tmpdir, INDEX)
+            )
+            queue.update_queue()
+
+            NAMESERVERS = ["10.0.0.1"]
+            for qe in queue:
+                qe.set_nameserver_complete(NAMESERVERS[0])
+                # nameserver no longer in config, never accepted the entry
+                qe.set_nameserver_incomplete("10.0.0.9")
+            for qe in queue:
+                self.assertIsNone(qe.completed())
+                self.assertEqual(
+                    qe.completed(NAMESERVERS), qe.nameservers[NAMESERVERS[0]]
+                )
+            self.assertEqual(queue.prune(NAMESERVERS, archivedir, max_age=0), 2)
+            self.assertEqual(len(queue), 0)
+
+    def test_bulk(self):
+        documents = []
+        for filename in ["1.yaml", "2.yaml"]:
+            with open(os.path.join(QUEUEDIR, filename)) as input_file:
+                documents.append(input_file.read())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            queuedir = os.path.join(tmpdir, "queue")
+            archivedir = os.path.join(tmpdir, "archive")
+            os.mkdir(queuedir)
+            os.mkdir(archivedir)
+            with open(os.path.join(queuedir, "bulk.ndjson"), "wt") as output_file:
+                for document in documents:
+                    output_file.write(json.dumps(yaml.safe_load(document)) + "\n")
+            bulk_yaml = os.path.join(queuedir, "bulk.bulk.yaml")
+            with open(bulk_yaml, "wt") as output_file:
+                output_file.write("---\n" + "---\n".join(documents))
+            index_filename = os.path.join(tmpdir, INDEX)
+            queue = ChangeRequestQueue(queue_directory=queuedir, index=index_filename)
+            queue.load_index()
+            queue.update_queue()
+            self.assertEqual(
+                sorted([qe.filename for qe in queue]),
+                [
+                    "bulk.bulk.yaml#1",
+                    "bulk.bulk.yaml#2",
+                    "bulk.ndjson#1",
+                    "bulk.ndjson#2",
+                ],
+            )
+            self.assertEqual(
+                queue.files["bulk.ndjson#2"].cr.change.to_text(), "b.example.com."
+            )
+            for qe in queue:
+                qe.set_nameserver_complete("10.0.0.1")
+            queue.save_index()
+
+            # unchanged bulk files are not read again
+            queue.load_index()
+            self.assertEqual(queue.ingest_file("bulk.ndjson"), [])
+
+            # only changed records are replaced
+            with open(bulk_yaml, "at") as output_file:
+                output_file.write("# changed\n")
+            self.assertEqual(
+                [qe.filename for qe in queue.ingest_file("bulk.bulk.yaml")],
+                ["bulk.bulk.yaml#2"],
+            )
+            self.assertFalse(queue.files["bulk.bulk.yaml#1"].is_pending("10.0.0.1"))
+            self.assertTrue(queue.files["bulk.bulk.yaml#2"].is_pending("10.0.0.1"))
+
+            # bulk files are archived once all records are complete
+            self.assertEqual(queue.prune(["10.0.0.1"], archivedir), 2)
+            self.assertEqual(
+                sorted(os.listdir(archivedir)), [ARCHIVE_FILENAME, "bulk.ndjson"]
+            )
+
 
 if __name__ == "__main__":
     unittest.main()
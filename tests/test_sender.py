@@ -0,0 +1,489 @@
+import asyncio
+import base64
+import dataclasses
+import os
+import time
+import unittest
+
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdataset
+import dns.rdatatype
+import dns.tsig
+import dns.zone
+from fakeserver import FakeServer
+
+from ddnsmulti.config import UpdaterConfig
+from ddnsmulti.connection import NameserverConnection
+from ddnsmulti.metrics import CONVERGENCE_DURATION, UPDATE_RESPONSES
+from ddnsmulti.preflight import APPLIED, IMPOSSIBLE, VIABLE, ZoneSnapshot, ZoneView
+from ddnsmulti.queue import ChangeRequestQueue, ChangeRequestQueueEntry
+from ddnsmulti.retry import CircuitBreaker
+from ddnsmulti.sender import UpdateSender, due_entries, schedule
+from ddnsmulti.wire import MessageCache
+from ddnsmulti.workers import partition, send_entries_parallel
+
+BASEDIR = os.path.abspath(os.path.dirname(__file__))
+QUEUEDIR = os.path.join(BASEDIR, "queue")
+
+TSIG_SECRET = "4Tc0K1QkcMCs7cOW2LuSWnxQY0qysdvsZlSb4yTN9pA="
+
+CONFIG_TEMPLATE = """
+queuedir: {queuedir}
+concurrency: 2
+nameservers:
+  - address: 127.0.0.1
+    port: {port1}
+  - address: 127.0.0.2
+    port: {port2}
+"""
+
+
+SCHEDULE_TEMPLATE = """
+zone: {zone}
+change: {change}.{zone}
+priority: {priority}
+from: []
+to:
+  - "{change}.{zone} NS ns1.{change}.{zone}"
+  - "ns1.{change}.{zone} A 10.0.0.1"
+"""
+
+
+PREFLIGHT_ZONE = """
+@ 3600 SOA ns1 hostmaster 1 3600 600 86400 3600
+@ 3600 NS ns1
+ns1 3600 A 10.0.0.53
+a 3600 NS ns1.a
+a 3600 NS ns4.a
+a 3600 NS ns2.b
+ns1.a 3600 A 10.0.0.1
+ns4.a 3600 A 10.0.0.2
+ns4.a 3600 AAAA 2001:67c:394:15::4
+b 3600 NS ns9.other
+"""
+
+
+def preflight_zone(*b_nameservers):
+    zone = dns.zone.from_text(PREFLIGHT_ZONE, origin="example.com", relativize=False)
+    if b_nameservers:
+        zone.replace_rdataset(
+            "b.example.com.", dns.rdataset.from_text("IN", "NS", 3600, *b_nameservers)
+        )
+    return zone
+
+
+class TestSchedule(unittest.TestCase):
+    def entry(self, zone, change, priority):
+        contents = SCHEDULE_TEMPLATE.format(zone=zone, change=change, priority=priority)
+        return ChangeRequestQueueEntry.from_contents(
+            f"{zone}-{change}-{priority}.yaml", contents.encode(), contents
+        )
+
+    def test_schedule(self):
+        bulk = [self.entry("a.test", f"n{n}", 10) for n in range(3)]
+        other = self.entry("b.test", "n0", 10)
+        urgent = self.entry("c.test", "n0", 0)
+        self.assertEqual(
+            schedule(bulk + [other, urgent]),
+            [urgent, bulk[0], other, bulk[1], bulk[2]],
+        )
+
+    def test_schedule_dependency(self):
+        routine = self.entry("a.test", "n0", 10)
+        other = self.entry("b.test", "n0", 5)
+        urgent = self.entry("a.test", "n0", 0)
+        self.assertEqual(schedule([routine, other, urgent]), [routine, urgent, other])
+
+    def test_due_entries(self):
+        first = self.entry("a.test", "n0", 10)
+        second = self.entry("a.test", "n0", 10)
+        other = self.entry("a.test", "n1", 10)
+        for n, qe in enumerate([first, second, other]):
+            qe.created = n
+        now = time.time()
+        entries = [second, other, first]
+        self.assertEqual(due_entries(entries, "10.0.0.1", now), [first, second, other])
+
+        # a later entry for the same name waits for the earlier one
+        first.set_nameserver_incomplete("10.0.0.1", retry_after=60)
+        self.assertEqual(due_entries(entries, "10.0.0.1", now), [other])
+        self.assertEqual(
+            due_entries(entries, "10.0.0.1", now + 120), [first, second, other]
+        )
+        first.set_nameserver_complete("10.0.0.1")
+        self.assertEqual(due_entries(entries, "10.0.0.1", now), [second, other])
+
+
+class TestSender(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server1 = FakeServer("127.0.0.1")
+        self.server2 = FakeServer("127.0.0.2", rcode=dns.rcode.REFUSED)
+        await self.server1.start()
+        await self.server2.start()
+        self.config = UpdaterConfig.from_yaml(
+            CONFIG_TEMPLATE.format(
+                queuedir=QUEUEDIR, port1=self.server1.port, port2=self.server2.port
+            )
+        )
+        self.queue = ChangeRequestQueue(queue_directory=QUEUEDIR)
+        self.queue.update_queue()
+
+    async def asyncTearDown(self):
+        await self.server1.stop()
+        await self.server2.stop()
+
+    async def test_send(self):
+        async with UpdateSender(self.config) as sender:
+            await sender.send(self.queue)
+        self.assertEqual(len(self.server1.received), len(self.queue))
+        self.assertEqual(len(self.server2.received), len(self.queue))
+        for qe in self.queue:
+            self.assertIsNotNone(qe.nameservers["127.0.0.1"])
+            self.assertIsNone(qe.nameservers["127.0.0.2"])
+            self.assertFalse(qe.is_complete())
+        self.assertEqual(self.server1.connections, 1)
+        self.assertEqual(self.server2.connections, 1)
+
+    async def test_skip_complete(self):
+        for qe in self.queue:
+            qe.set_nameserver_complete("127.0.0.1")
+        async with UpdateSender(self.config) as sender:
+            await sender.send(self.queue)
+        self.assertEqual(len(self.server1.received), 0)
+        self.assertEqual(len(self.server2.received), len(self.queue))
+
+    async def test_batch(self):
+        config = dataclasses.replace(self.config, batch_size=10)
+        async with UpdateSender(config) as sender:
+            await sender.send(self.queue)
+        self.assertEqual(len(self.server1.received), 1)
+        for qe in self.queue:
+            self.assertIsNotNone(qe.nameservers["127.0.0.1"])
+
+    async def test_batch_bisect(self):
+        await self.server1.stop()
+        self.server1 = FakeServer("127.0.0.1", reject={"b.example.com"})
+        await self.server1.start()
+        config = dataclasses.replace(self.config, batch_size=10)
+        config.nameservers[0]["port"] = self.server1.port
+        async with UpdateSender(config) as sender:
+            await sender.send(self.queue)
+        self.assertEqual(len(self.server1.received), 3)
+        for qe in self.queue:
+            if qe.cr.change == dns.name.from_text("b.example.com"):
+                self.assertIsNone(qe.nameservers["127.0.0.1"])
+            else:
+                self.assertIsNotNone(qe.nameservers["127.0.0.1"])
+
+    async def test_tsig(self):
+        key = dns.tsig.Key("key1.", base64.b64decode(TSIG_SECRET), "hmac-sha256")
+        await self.server1.stop()
+        self.server1 = FakeServer("127.0.0.1", keyring=key)
+        await self.server1.start()
+        self.config.nameservers[0]["port"] = self.server1.port
+        self.config.nameservers[0]["tsig"] = {
+            "name": key.name,
+            "key": key.secret,
+            "alg": key.algorithm,
+        }
+        messages = MessageCache()
+        async with UpdateSender(self.config, messages=messages) as sender:
+            await sender.send(self.queue)
+        self.assertEqual(len(messages), len(self.queue))
+        for request in self.server1.received:
+            self.assertTrue(request.had_tsig)
+        for qe in self.queue:
+            self.assertIsNotNone(qe.nameservers["127.0.0.1"])
+
+    async def test_retry_backoff(self):
+        async with UpdateSender(self.config) as sender:
+            await sender.send(self.queue)
+            for qe in self.queue:
+                self.assertEqual(qe.attempts("127.0.0.2"), 1)
+                self.assertFalse(qe.is_due("127.0.0.2"))
+            await sender.send(self.queue)
+        self.assertEqual(len(self.server2.received), len(self.queue))
+
+    async def test_circuit_breaker(self):
+        await self.server1.stop()
+        self.server1 = FakeServer("127.0.0.1", silent=True)
+        await self.server1.start()
+        config = dataclasses.replace(self.config, retry={**self.config.retry})
+        config.retry["breaker_threshold"] = 1
+        config.retry["initial_delay"] = 0
+        config.nameservers[0].update(port=self.server1.port, timeout=0.2, concurrency=1)
+        async with UpdateSender(config) as sender:
+            await sender.send(self.queue)
+            self.assertEqual(len(self.server1.received), 1)
+            self.assertTrue(sender.breakers["127.0.0.1"].is_open)
+
+            # a single probe is sent in the next cycle
+            for qe in self.queue:
+                qe.retries.clear()
+            await sender.send(self.queue)
+            self.assertEqual(len(self.server1.received), 2)
+            self.assertTrue(sender.breakers["127.0.0.1"].is_open)
+        for qe in self.queue:
+            self.assertIsNone(qe.nameservers.get("127.0.0.1"))
+
+    async def test_circuit_breaker_state(self):
+        await self.server1.stop()
+        self.server1 = FakeServer("127.0.0.1", silent=True)
+        await self.server1.start()
+        config = dataclasses.replace(self.config, retry={**self.config.retry})
+        config.retry["breaker_threshold"] = 1
+        config.nameservers[0].update(port=self.server1.port, timeout=0.2, concurrency=1)
+        async with UpdateSender(config, queue=self.queue) as sender:
+            await sender.send(self.queue)
+        self.assertEqual(len(self.server1.received), 1)
+        self.assertGreater(self.queue.breakers["127.0.0.1"], time.time())
+
+        # the next run skips the nameserver until the breaker delay has passed
+        for qe in self.queue:
+            qe.retries.clear()
+        async with UpdateSender(config, queue=self.queue) as sender:
+            await sender.send(self.queue)
+        self.assertEqual(len(self.server1.received), 1)
+
+        self.queue.set_breaker("127.0.0.1", time.time())
+        async with UpdateSender(config, queue=self.queue) as sender:
+            await sender.send(self.queue)
+        self.assertEqual(len(self.server1.received), 2)
+        self.assertGreater(self.queue.breakers["127.0.0.1"], time.time())
+
+        changes = []
+        breaker = CircuitBreaker(
+            "127.0.0.1",
+            open_until=time.time(),
+            on_change=lambda address, value: changes.append((address, value)),
+        )
+        breaker.new_cycle()
+        breaker.success()
+        self.assertEqual(changes, [("127.0.0.1", None)])
+
+    async def test_slow_nameserver(self):
+        await self.server1.stop()
+        self.server1 = FakeServer("127.0.0.1", silent=True)
+        await self.server1.start()
+        config = dataclasses.replace(self.config, retry={**self.config.retry})
+        config.nameservers[0].update(port=self.server1.port, timeout=1, concurrency=1)
+        config.nameservers[1].update(concurrency=1)
+        async with UpdateSender(config) as sender:
+            task = asyncio.create_task(sender.send(self.queue))
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            while len(self.server2.received) < len(self.queue):
+                self.assertLess(loop.time() - start, 0.5)
+                await asyncio.sleep(0.01)
+            await task
+
+    async def run_transport(self, transport: str, **kwargs):
+        await self.server1.stop()
+        self.server1 = FakeServer("127.0.0.1", udp=True, **kwargs)
+        await self.server1.start()
+        self.config.nameservers[0].update(port=self.server1.port, transport=transport)
+        async with UpdateSender(self.config) as sender:
+            await sender.send(self.queue)
+        for qe in self.queue:
+            self.assertIsNotNone(qe.nameservers["127.0.0.1"])
+
+    async def test_preflight(self):
+        await self.server1.stop()
+        zone = preflight_zone("ns1.other.example.com.", "ns2.other.example.com.")
+        self.server1 = FakeServer("127.0.0.1", zone=zone)
+        await self.server1.start()
+        config = UpdaterConfig.from_yaml(
+            CONFIG_TEMPLATE.format(
+                queuedir=QUEUEDIR, port1=self.server1.port, port2=self.server2.port
+            )
+        )
+        config.nameservers[0]["preflight"] = True
+        first, second = sorted(self.queue, key=lambda qe: qe.filename)
+        async with UpdateSender(config) as sender:
+            await sender.send(self.queue)
+            self.assertEqual(len(self.server1.transfers), 1)
+            self.assertEqual(
+                self.server1.transfers[0].question[0].rdtype, dns.rdatatype.AXFR
+            )
+            self.assertEqual(len(self.server1.received), 1)
+            self.assertEqual(self.server1.received[0].update[0].name, second.cr.change)
+            self.assertIsNotNone(first.nameservers["127.0.0.1"])
+            self.assertIsNotNone(second.nameservers["127.0.0.1"])
+
+            second.set_nameserver_incomplete("127.0.0.1")
+            self.assertEqual(
+                await sender.preflight(config.nameservers[0], [second]), [second]
+            )
+            self.assertEqual(
+                self.server1.transfers[1].question[0].rdtype, dns.rdatatype.IXFR
+            )
+
+    async def test_verify(self):
+        await self.server1.stop()
+        self.server1 = FakeServer("127.0.0.1", zone=preflight_zone())
+        await self.server1.start()
+        config = UpdaterConfig.from_yaml(
+            CONFIG_TEMPLATE.format(
+                queuedir=QUEUEDIR, port1=self.server1.port, port2=self.server2.port
+            )
+        )
+        config.nameservers[0]["verify"] = True
+        first, second = sorted(self.queue, key=lambda qe: qe.filename)
+        async with UpdateSender(config) as sender:
+            await sender.send(self.queue)
+            self.assertTrue(first.is_verified("127.0.0.1"))
+            self.assertFalse(second.is_verified("127.0.0.1"))
+            self.assertFalse(first.is_verified("127.0.0.2"))
+            self.assertIsNotNone(first.converged(config.verify_addresses))
+            self.assertEqual(self.queue.unverified(["127.0.0.1"]), [second])
+
+            # NS for a and b, A for ns1.a, ns2.a and ns4.a, AAAA for ns4.a
+            queries = len(self.server1.queries)
+            self.assertEqual(queries, 6)
+            self.server1.zone = preflight_zone(
+                "ns3.other.example.com.", "ns4.other.example.com."
+            )
+            await sender.verify(self.queue)
+            self.assertTrue(second.is_verified("127.0.0.1"))
+            self.assertEqual(len(self.server1.queries), queries + 1)
+        self.assertIn(
+            {
+                "op": "verified",
+                "filename": second.filename,
+                "nameserver": "127.0.0.1",
+                "value": second.verified["127.0.0.1"],
+            },
+            self.queue.changes,
+        )
+
+    def test_zone_view(self):
+        zone = preflight_zone()
+        snapshot = ZoneSnapshot(zone.origin)
+        snapshot.zone = zone
+        first, second = sorted(self.queue, key=lambda qe: qe.filename)
+        view = ZoneView(snapshot)
+        self.assertEqual(view.evaluate(first.cr), APPLIED)
+        self.assertEqual(view.evaluate(second.cr), IMPOSSIBLE)
+
+        snapshot.zone = preflight_zone(
+            "ns1.other.example.com.", "ns2.other.example.com."
+        )
+        view = ZoneView(snapshot)
+        self.assertEqual(view.evaluate(second.cr), VIABLE)
+        self.assertEqual(view.evaluate(second.cr), APPLIED)
+
+    async def test_workers(self):
+        self.assertEqual(partition([1, 2, 3], 2), [[1, 3], [2]])
+        self.assertEqual(partition([1], 4), [[1]])
+        self.queue.changes = []
+        responses = UPDATE_RESPONSES.labels("127.0.0.2", "REFUSED").value
+        await asyncio.to_thread(
+            send_entries_parallel,
+            self.config,
+            list(self.queue),
+            workers=2,
+            queue=self.queue,
+        )
+        self.assertEqual(len(self.server1.received), len(self.queue))
+        self.assertEqual(len(self.server2.received), len(self.queue))
+        for qe in self.queue:
+            self.assertIsNotNone(qe.nameservers["127.0.0.1"])
+            self.assertIsNone(qe.nameservers["127.0.0.2"])
+            self.assertEqual(qe.attempts("127.0.0.2"), 1)
+        self.assertEqual(len(self.queue.changes), 2 * len(self.queue))
+        self.assertEqual(
+            UPDATE_RESPONSES.labels("127.0.0.2", "REFUSED").value,
+            responses + len(self.queue),
+        )
+
+    async def test_workers_verify(self):
+        for server in (self.server1, self.server2):
+            await server.stop()
+        self.server1 = FakeServer("127.0.0.1", zone=preflight_zone())
+        self.server2 = FakeServer("127.0.0.2", zone=preflight_zone())
+        await self.server1.start()
+        await self.server2.start()
+        config = UpdaterConfig.from_yaml(
+            CONFIG_TEMPLATE.format(
+                queuedir=QUEUEDIR, port1=self.server1.port, port2=self.server2.port
+            )
+        )
+        for nameserver in config.nameservers:
+            nameserver["verify"] = True
+        first, second = sorted(self.queue, key=lambda qe: qe.filename)
+        converged = CONVERGENCE_DURATION.labels(first.zone).count
+        await asyncio.to_thread(
+            send_entries_parallel, config, list(self.queue), workers=2
+        )
+        self.assertTrue(first.is_verified("127.0.0.1"))
+        self.assertTrue(first.is_verified("127.0.0.2"))
+        self.assertFalse(second.is_verified("127.0.0.1"))
+        # each worker verifies at one nameserver, converged once at both
+        self.assertEqual(CONVERGENCE_DURATION.labels(first.zone).count, converged + 1)
+
+    async def test_udp(self):
+        await self.run_transport("udp")
+        self.assertEqual(len(self.server1.received_udp), len(self.queue))
+        self.assertEqual(len(self.server1.received), 0)
+
+    async def test_auto_fallback(self):
+        await self.run_transport("auto", truncate=True)
+        self.assertEqual(len(self.server1.received_udp), len(self.queue))
+        self.assertEqual(len(self.server1.received), len(self.queue))
+
+    async def test_auto_resend(self):
+        await self.server1.stop()
+        self.server1 = FakeServer(
+            "127.0.0.1",
+            rcode=dns.rcode.NXRRSET,
+            udp=True,
+            silent_udp=True,
+            zone=preflight_zone(),
+        )
+        await self.server1.start()
+        self.config.nameservers[0].update(
+            port=self.server1.port, transport="auto", udp_timeout=0.1
+        )
+        first, second = sorted(self.queue, key=lambda qe: qe.filename)
+        async with UpdateSender(self.config) as sender:
+            await sender.send(self.queue)
+        self.assertEqual(len(self.server1.received_udp), len(self.queue))
+        self.assertEqual(len(self.server1.received), len(self.queue))
+        # the first copy may have been applied, confirmed by querying
+        self.assertIsNotNone(first.nameservers["127.0.0.1"])
+        self.assertIsNone(second.nameservers["127.0.0.1"])
+
+
+class TestConnection(unittest.IsolatedAsyncioTestCase):
+    async def test_backoff(self):
+        server = FakeServer("127.0.0.1")
+        await server.start()
+        port = server.port
+        await server.stop()
+        connection = NameserverConnection("127.0.0.1", port)
+        with self.assertRaises(ConnectionRefusedError):
+            await connection.connect()
+        with self.assertRaises(ConnectionError) as cm:
+            await connection.connect()
+        self.assertIn("retry", str(cm.exception))
+
+    async def test_reconnect(self):
+        server = FakeServer("127.0.0.1")
+        await server.start()
+        connection = NameserverConnection("127.0.0.1", server.port)
+        queue = ChangeRequestQueue(queue_directory=QUEUEDIR)
+        queue.update_queue()
+        for qe in queue:
+            response = await connection.query(
+                qe.cr.to_message().to_wire(), key=None, timeout=5
+            )
+            self.assertEqual(response.rcode(), dns.rcode.NOERROR)
+            await connection.close()
+        self.assertEqual(server.connections, len(queue))
+        await server.stop()
+
+
+if __name__ == "__main__":
+    unittest.main()
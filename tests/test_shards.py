@@ -0,0 +1,91 @@
+import argparse
+import os
+import shutil
+import tempfile
+import unittest
+
+import voluptuous as vol
+
+from ddnsmulti.commands import get_queue, run_sharded
+from ddnsmulti.config import UpdaterConfig
+from ddnsmulti.metrics import UPDATE_ERRORS
+from ddnsmulti.shards import distribute, list_shards, shard_name
+
+BASEDIR = os.path.abspath(os.path.dirname(__file__))
+QUEUEDIR = os.path.join(BASEDIR, "queue")
+
+CONFIG_TEMPLATE = """
+queuedir: {queuedir}
+index: {index}
+shards:
+  layout: {layout}
+nameservers:
+  - address: 10.0.0.1
+"""
+
+
+class TestShards(unittest.TestCase):
+    def test_shard_name(self):
+        self.assertEqual(len(shard_name("1.yaml", "hash")), 2)
+        self.assertEqual(shard_name("1.yaml", "hash"), shard_name("1.yaml", "hash"))
+        self.assertEqual(shard_name("1.yaml", "date", 0), "19700101")
+
+    def test_index_placeholder(self):
+        with self.assertRaises(vol.Invalid):
+            UpdaterConfig.from_yaml(
+                CONFIG_TEMPLATE.format(
+                    queuedir="/tmp", index="index.json", layout="hash"
+                )
+            )
+
+    def test_sharded_queue(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            queuedir = os.path.join(tmpdir, "queue")
+            os.mkdir(queuedir)
+            for filename in ["1.yaml", "2.yaml"]:
+                shutil.copy(os.path.join(QUEUEDIR, filename), queuedir)
+            config = UpdaterConfig.from_yaml(
+                CONFIG_TEMPLATE.format(
+                    queuedir=queuedir,
+                    index=os.path.join(queuedir, "{shard}", "index.json"),
+                    layout="date",
+                )
+            )
+            self.assertEqual(distribute(queuedir, "date"), 2)
+            shards = list_shards(queuedir)
+            self.assertEqual(len(shards), 1)
+
+            shard_config = config.for_shard(shards[0])
+            self.assertEqual(
+                shard_config.index, os.path.join(queuedir, shards[0], "index.json")
+            )
+            queue = get_queue(shard_config)
+            queue.load_index()
+            queue.update_queue()
+            queue.save_index()
+            self.assertEqual(len(queue), 2)
+            self.assertTrue(os.path.exists(shard_config.index))
+
+    def test_shard_metrics(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for shard in ["a", "b"]:
+                os.mkdir(os.path.join(tmpdir, shard))
+            config = UpdaterConfig.from_yaml(
+                CONFIG_TEMPLATE.format(
+                    queuedir=tmpdir,
+                    index=os.path.join(tmpdir, "{shard}", "index.json"),
+                    layout="hash",
+                )
+            )
+            errors = []
+
+            def command(shard_config, args):
+                UPDATE_ERRORS.labels("10.0.0.1").inc()
+                errors.append(UPDATE_ERRORS.labels("10.0.0.1").value)
+
+            run_sharded(config, argparse.Namespace(shard=None, func=command))
+            self.assertEqual(errors, [1, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()